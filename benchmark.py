@@ -0,0 +1,193 @@
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from absl import app, flags
+from mock_server import MockConfig, make_server
+
+
+flags.DEFINE_list('scenarios', ["GEMBA-DA", "GEMBA-MQM", "GEMBA-DA-POLYCAND", "GEMBA-DA-POLYIC"], 'Methods to benchmark.')
+flags.DEFINE_list('concurrency', ["16", "64", "256"], 'Numbers of concurrent requests to benchmark each method at.')
+flags.DEFINE_integer('segments', 2000, 'Number of distinct segments scored per run.')
+# latency and fault flags come from mock_server, with defaults resembling a busy endpoint
+flags.FLAGS.set_default('latency', "lognormal:0.05:0.5")
+flags.FLAGS.set_default('rate_limit_rate', 0.02)
+flags.FLAGS.set_default('server_error_rate', 0.01)
+flags.FLAGS.set_default('truncate_rate', 0.02)
+flags.FLAGS.set_default('garbage_rate', 0.05)
+flags.FLAGS.set_default('seed', 1)
+flags.DEFINE_string('baseline', "benchmark_baseline.json", 'Filepath of the stored baseline results.')
+flags.DEFINE_boolean('update_baseline', False, 'Store the results as the new baseline instead of comparing against it.')
+flags.DEFINE_float('tolerance', 0.25, 'Relative slowdown (or growth of p99 latency and peak RSS) tolerated against the baseline.')
+flags.DEFINE_string('output', None, 'Filepath to write the results to as JSON.')
+
+######
+# End-to-end throughput benchmark of GptApi against the local mock server, without any paid calls.
+# Every run scores fresh segments with an empty cache in its own process, so peak RSS is per run.
+# Exits with 1 when any run regressed against the baseline by more than the tolerance.
+######
+
+MODEL = "gpt-4"
+
+# higher is better for throughput, lower for the others
+GATED_METRICS = {"requests_per_second": 1, "segments_per_second": 1, "p99_latency": -1, "peak_rss_mb": -1}
+
+WORDS = "the a translation quality model system house river green fast slowly report meeting city paper".split()
+
+
+def make_segments(count, seed):
+    rng = random.Random(seed)
+    return [f"{i} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))) + "." for i in range(count)]
+
+
+def make_poly_frame(scenario, count, seed):
+    """Input of get_gemba_scores_polycand and get_gemba_scores_polyic."""
+    sources = make_segments(count, seed)
+    translations = make_segments(count, seed + 1)
+    rng = random.Random(seed)
+    data = {"langs": ["wmt/en-de"] * count, "src": sources, "ref": translations, "mt": translations, "score": [rng.randint(0, 100) for _ in range(count)]}
+    for i in range(2, 7):
+        if scenario == "GEMBA-DA-POLYIC":
+            data[f"src{i}"] = make_segments(count, seed + i * 10)
+        data[f"mt{i}"] = make_segments(count, seed + i * 10 + 1)
+        data[f"score{i}"] = [rng.randint(0, 100) for _ in range(count)]
+    return pd.DataFrame(data)
+
+
+def serve(config, queue):
+    server = make_server(config=config)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def run_scenario(scenario, concurrency, segments, seed, base_url):
+    """Scores the segments of a scenario against the mock server at base_url, runs in a fresh process."""
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    # caches start empty and are thrown away
+    os.chdir(tempfile.mkdtemp(prefix="gemba-benchmark-"))
+    # progress bars, retry and parser messages of the run, errors still reach the parent as exceptions
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+
+    from gemba.gpt_api import GptApi
+    from gemba.utils import get_gemba_scores, get_gemba_scores_polycand, get_gemba_scores_polyic
+
+    gptapi = GptApi(min_concurrency=concurrency, max_concurrency=concurrency)
+    latencies = []
+    call_api = gptapi.call_api
+
+    async def timed_call_api(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await call_api(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    gptapi.call_api = timed_call_api
+
+    start = time.perf_counter()
+    if scenario == "GEMBA-DA-POLYCAND":
+        answers = [answer["answer"] for answer in get_gemba_scores_polycand(make_poly_frame(scenario, segments, seed), scenario, MODEL, gptapi=gptapi)]
+    elif scenario == "GEMBA-DA-POLYIC":
+        answers = [answer["answer"] for answer in get_gemba_scores_polyic(make_poly_frame(scenario, segments, seed), scenario, MODEL, gptapi=gptapi)]
+    else:
+        answers = get_gemba_scores(make_segments(segments, seed), make_segments(segments, seed + 1), "English", "German", scenario, MODEL, gptapi=gptapi)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "elapsed": elapsed,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "segments_per_second": segments / elapsed,
+        "p50_latency": float(np.percentile(latencies, 50)),
+        "p99_latency": float(np.percentile(latencies, 99)),
+        "retries": gptapi.stats["retries"] + gptapi.stats["parse_retries"] + gptapi.stats["truncation_retries"],
+        "unscored": sum(answer is None for answer in answers),
+        "stats": dict(gptapi.stats),
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_benchmark(scenarios, concurrency_levels, segments, config_args, seed):
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for scenario in scenarios:
+        for concurrency in concurrency_levels:
+            # a fresh server per run, so every run sees the same sequence of latencies and faults
+            queue = context.Queue()
+            server = context.Process(target=serve, args=(MockConfig(**config_args, seed=seed), queue), daemon=True)
+            server.start()
+            base_url = f"http://127.0.0.1:{queue.get()}/v1"
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_scenario, scenario, concurrency, segments, seed, base_url).result()
+            finally:
+                server.terminate()
+                server.join()
+
+            name = f"{scenario}@{concurrency}"
+            results[name] = result
+            print(f"{name}\t{result['requests_per_second']:.1f} req/s\t{result['segments_per_second']:.1f} seg/s\t"
+                  f"p50 {result['p50_latency'] * 1000:.0f}ms\tp99 {result['p99_latency'] * 1000:.0f}ms\t"
+                  f"{result['retries']} retries\t{result['unscored']} unscored\t{result['peak_rss_mb']:.0f}MB", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against the baseline as (run, metric, baseline value, value)."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, direction in GATED_METRICS.items():
+            expected = baseline[name][metric]
+            if direction > 0 and result[metric] < expected * (1 - tolerance):
+                regressions.append((name, metric, expected, result[metric]))
+            elif direction < 0 and result[metric] > expected * (1 + tolerance):
+                regressions.append((name, metric, expected, result[metric]))
+    return regressions
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    config_args = {
+        "latency": FLAGS.latency,
+        "rate_limit_rate": FLAGS.rate_limit_rate,
+        "server_error_rate": FLAGS.server_error_rate,
+        "truncate_rate": FLAGS.truncate_rate,
+        "garbage_rate": FLAGS.garbage_rate,
+    }
+    results = run_benchmark(FLAGS.scenarios, [int(c) for c in FLAGS.concurrency], FLAGS.segments, config_args, FLAGS.seed)
+
+    if FLAGS.output is not None:
+        with open(FLAGS.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if FLAGS.update_baseline:
+        with open(FLAGS.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {FLAGS.baseline}")
+        return
+
+    if not os.path.isfile(FLAGS.baseline):
+        print(f"No baseline at {FLAGS.baseline}, store one with --update_baseline.")
+        return
+    with open(FLAGS.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, FLAGS.tolerance)
+    for name, metric, expected, value in regressions:
+        print(f"Regression in {name}: {metric} {value:.3f} vs. {expected:.3f} in the baseline")
+    if len(regressions) > 0:
+        sys.exit(1)
+    print(f"No regressions against {FLAGS.baseline}")
+
+
+if __name__ == "__main__":
+    app.run(main)
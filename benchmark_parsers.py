@@ -0,0 +1,248 @@
+import contextlib
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from absl import app, flags
+from gemba.cache import open_disk_cache
+from gemba.gemba_mqm_utils import parse_mqm_answer, parse_broken_json
+from gemba.prompt import prompts, validate_number, validate_number_polygemba, validate_stars
+
+
+flags.DEFINE_string('corpus', "parser_corpus.jsonl", 'Filepath of the corpus of raw answers with the expected parser outputs.')
+flags.DEFINE_boolean('export', False, 'Sample answers from the caches in --cache_root_dir and add them to the corpus.')
+flags.DEFINE_string('cache_root_dir', "cache", 'Path to the cache directory to export answers from.')
+flags.DEFINE_integer('max_answers', 1000, 'Maximum number of distinct answers exported per cache.')
+flags.DEFINE_integer('seed', 1, 'Seed of the sampling of exported answers.')
+flags.DEFINE_boolean('refresh_expected', False, 'Store the outputs of the current parsers as expected, after an intended change of a parser.')
+flags.DEFINE_float('min_time', 0.2, 'Minimum seconds of each timed round of a parser.')
+flags.DEFINE_integer('repeat', 5, 'Number of timed rounds of each parser, the fastest one is reported.')
+flags.DEFINE_string('baseline', "parser_baseline.json", 'Filepath of the stored baseline results.')
+flags.DEFINE_boolean('update_baseline', False, 'Store the results as the new baseline instead of comparing against it.')
+flags.DEFINE_float('tolerance', 0.25, 'Relative growth of the parse time per answer tolerated against the baseline.')
+flags.DEFINE_string('output', None, 'Filepath to write the results to as JSON.')
+
+######
+# Micro-benchmark of the answer parsers over a corpus of raw answers, without any API call.
+# The corpus stores the expected output of every answer, so it is also a regression set: any changed output
+# is reported and exits with 1, as does a parse time per answer slower than the baseline beyond the tolerance.
+######
+
+# parsers as called by the pipeline, keyed by the name used in the corpus
+PARSERS = {
+    "parse_mqm_answer": lambda x: parse_mqm_answer(x, list_mqm_errors=False, full_desc=True),
+    "parse_broken_json": parse_broken_json,
+    "validate_number": validate_number,
+    "validate_stars": validate_stars,
+    "parse_classes": prompts["GEMBA-classes"]["validate_answer"],
+    "validate_number_polygemba": validate_number_polygemba,
+}
+
+# parser of the answers in the cache of each single-stage method
+METHOD_PARSERS = {
+    "GEMBA-MQM": "parse_mqm_answer",
+    **{method: "validate_number" for method in ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref"]},
+    **{method: "validate_stars" for method in ["GEMBA-stars", "GEMBA-stars_ref"]},
+    **{method: "parse_classes" for method in ["GEMBA-classes", "GEMBA-classes_ref"]},
+    **{method: "validate_number_polygemba" for method in ["GEMBA-DA-POLYCAND", "GEMBA-DA-POLYIC"]},
+}
+
+
+def normalize(output):
+    # expected outputs are stored as JSON, defaultdicts and tuples compare equal after a round trip
+    return json.loads(json.dumps(output))
+
+
+def parse(parser, answer):
+    # parsers print the lines they don't understand
+    with contextlib.redirect_stdout(None):
+        return normalize(PARSERS[parser](answer))
+
+
+def cache_method(dirname):
+    """Method of a cache directory named {model}_{method}, polycand and polyic caches have a suffix of their options."""
+    for method in sorted(METHOD_PARSERS, key=len, reverse=True):
+        if dirname.endswith(f"_{method}") or f"_{method}_" in dirname:
+            return method
+    return None
+
+
+def sample_cache(cache, max_answers, rng):
+    """Reservoir sample of the distinct complete answers in a cache."""
+    sample = []
+    seen = set()
+    for key in cache.iterkeys():
+        for answer in cache.get(key) or []:
+            # truncated answers are never parsed
+            if answer.get("finish_reason") != "stop" or answer["answer"] is None or answer["answer"] in seen:
+                continue
+            seen.add(answer["answer"])
+            if len(sample) < max_answers:
+                sample.append(answer["answer"])
+            else:
+                i = rng.randrange(len(seen))
+                if i < max_answers:
+                    sample[i] = answer["answer"]
+    return sample
+
+
+def export_caches(cache_root_dir, max_answers, seed):
+    entries = []
+    for dirname in sorted(os.listdir(cache_root_dir)):
+        method = cache_method(dirname)
+        if method is None:
+            # e.g. GEMBA-ESA, its cache mixes the answers of both stages
+            print(f"Skipping {dirname}, not a cache of a single-stage method", file=sys.stderr)
+            continue
+        cache = open_disk_cache(f"{cache_root_dir}/{dirname}")
+        answers = sample_cache(cache, max_answers, random.Random(seed))
+        cache.close()
+        print(f"Exported {len(answers)} answers of {dirname}", file=sys.stderr)
+
+        parser = METHOD_PARSERS[method]
+        entries += [{"parser": parser, "method": method, "answer": answer} for answer in answers]
+        if parser == "parse_mqm_answer":
+            # answers in the JSON format which fails to load go through parse_broken_json
+            entries += [{"parser": "parse_broken_json", "method": method, "answer": answer} for answer in answers if answer.startswith('{"improved translation"')]
+    return entries
+
+
+def read_corpus(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_corpus(path, entries):
+    with open(path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def corpus_digest(entries):
+    digest = hashlib.blake2b(digest_size=8)
+    for entry in entries:
+        digest.update(json.dumps([entry["parser"], entry["answer"]], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def check_corpus(entries):
+    """Returns the entries whose parsed output differs from the expected one as (entry, output)."""
+    mismatches = []
+    for entry in entries:
+        output = parse(entry["parser"], entry["answer"])
+        if output != entry["expected"]:
+            mismatches.append((entry, output))
+    return mismatches
+
+
+def time_parser(parser, answers, min_time, repeat):
+    """Fastest time per answer in microseconds over the rounds, each round parses the answers until min_time passed."""
+    parse_answer = PARSERS[parser]
+    best = None
+    with contextlib.redirect_stdout(None):
+        for _ in range(repeat):
+            count = 0
+            start = time.perf_counter()
+            while True:
+                for answer in answers:
+                    parse_answer(answer)
+                count += len(answers)
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+            if best is None or elapsed / count < best:
+                best = elapsed / count
+    return best * 1e6
+
+
+def run_benchmark(entries, min_time, repeat):
+    results = {}
+    for parser in PARSERS:
+        answers = [entry["answer"] for entry in entries if entry["parser"] == parser]
+        if len(answers) == 0:
+            continue
+        us_per_answer = time_parser(parser, answers, min_time, repeat)
+        results[parser] = {
+            "answers": len(answers),
+            "mean_length": sum(len(answer) for answer in answers) / len(answers),
+            # also the seconds to re-parse a million cached answers
+            "us_per_answer": us_per_answer,
+        }
+        print(f"{parser}\t{len(answers)} answers\t{us_per_answer:.2f}us/answer\t{1e6 / us_per_answer:.0f} answers/s", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against the baseline as (parser, baseline value, value)."""
+    regressions = []
+    for parser, result in results.items():
+        if parser not in baseline["parsers"]:
+            continue
+        expected = baseline["parsers"][parser]["us_per_answer"]
+        if result["us_per_answer"] > expected * (1 + tolerance):
+            regressions.append((parser, expected, result["us_per_answer"]))
+    return regressions
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+
+    entries = read_corpus(FLAGS.corpus) if os.path.isfile(FLAGS.corpus) else []
+    if FLAGS.export:
+        known = {(entry["parser"], entry["answer"]) for entry in entries}
+        exported = [entry for entry in export_caches(FLAGS.cache_root_dir, FLAGS.max_answers, FLAGS.seed) if (entry["parser"], entry["answer"]) not in known]
+        for entry in exported:
+            entry["expected"] = parse(entry["parser"], entry["answer"])
+        write_corpus(FLAGS.corpus, entries + exported)
+        print(f"Added {len(exported)} answers to {FLAGS.corpus}")
+        return
+
+    assert len(entries) > 0, f"No answers in {FLAGS.corpus}, export some with --export."
+    unknown = {entry["parser"] for entry in entries} - set(PARSERS)
+    assert len(unknown) == 0, f"Unknown parsers in the corpus: {unknown}"
+
+    if FLAGS.refresh_expected:
+        for entry in entries:
+            entry["expected"] = parse(entry["parser"], entry["answer"])
+        write_corpus(FLAGS.corpus, entries)
+        print(f"Expected outputs of {len(entries)} answers refreshed in {FLAGS.corpus}")
+        return
+
+    mismatches = check_corpus(entries)
+    for entry, output in mismatches:
+        print(f"Changed output of {entry['parser']} for {entry['answer']!r}: {output!r} instead of {entry['expected']!r}")
+
+    results = {"corpus": corpus_digest(entries), "parsers": run_benchmark(entries, FLAGS.min_time, FLAGS.repeat)}
+    if FLAGS.output is not None:
+        with open(FLAGS.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if FLAGS.update_baseline:
+        with open(FLAGS.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {FLAGS.baseline}")
+    elif not os.path.isfile(FLAGS.baseline):
+        print(f"No baseline at {FLAGS.baseline}, store one with --update_baseline.")
+    else:
+        with open(FLAGS.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != results["corpus"]:
+            # times of different answers can't be compared
+            print(f"The corpus changed since {FLAGS.baseline} was stored, update it with --update_baseline.")
+        else:
+            regressions = compare(results, baseline, FLAGS.tolerance)
+            for parser, expected, value in regressions:
+                print(f"Regression in {parser}: {value:.2f}us per answer vs. {expected:.2f}us in the baseline")
+            if len(regressions) > 0:
+                sys.exit(1)
+            print(f"No regressions against {FLAGS.baseline}")
+
+    if len(mismatches) > 0:
+        print(f"{len(mismatches)} of {len(entries)} answers parse differently than expected")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,25 +1,55 @@
 import sys
-from mt_metrics_eval import data
-from gemba.mtme_tools import eval_metrics
+from absl import app, flags
+from gemba.cache import open_disk_cache
+from gemba.meta_eval import evaluate
 
 
-dataset = "wmt22"
-focus_lps = ['en-de', 'en-ru', 'zh-en']
-FINAL_MODELS = []
-path = "scores/mt-metrics-eval-v2"
+flags.DEFINE_string('path', "scores/mt-metrics-eval-v2", 'Path to the mt-metrics-eval data.')
+flags.DEFINE_string('dataset', "wmt22", 'Dataset to evaluate on.')
+flags.DEFINE_list('lps', ['en-de', 'en-ru', 'zh-en'], 'Language pairs to evaluate on.')
+flags.DEFINE_list('metrics', None, 'Globs of the metric names to compare, e.g. "GEMBA-*-refA,BLEU-refA". Only their score files are read and the correlations are computed without significance tests.')
+flags.DEFINE_list('levels', ['sys'], 'Levels of the correlations with --metrics, sys and/or seg.')
+flags.DEFINE_string('gold', "mqm", 'Name of the gold scores.')
+flags.DEFINE_enum('engine', "mtme", ["mtme", "numpy"], 'Engine of the significance tests: mtme runs the permutation tests of mt-metrics-eval, numpy a faster vectorized paired bootstrap which only approximates them, so its clusters and ranks can differ.')
+flags.DEFINE_string('cache_root_dir', "cache", 'Path to the cache directory, parsed score files are kept in its metric_scores subdirectory.')
 
-eval_sets = {}
-for lp in focus_lps:
-    print(lp, file=sys.stderr)
-    eval_sets[lp] = data.EvalSet(dataset, lp, True, path=path)
+######
+# Without --metrics, evaluates all metrics of the dataset with mt-metrics-eval and 1000 bootstrap resamples.
+# With --metrics, only the matching score files and the gold scores are read for a quick comparison.
+######
 
-appraise_results = eval_metrics(
-    eval_sets, focus_lps, ['sys'], primary_only=False, k=0,
-    gold_name="mqm", include_domains=False, seg_level_no_avg=True,
-    include_human_with_acc=False)
-results = appraise_results[list(appraise_results.keys())[0]]
 
-print(f"Accuracy results")
-for key in results.keys():
-    print(f"{key}\t{results[key][1]:.3f}")
+def main(argv):
+    FLAGS = flags.FLAGS
 
+    if FLAGS.metrics is not None:
+        cache = open_disk_cache(f"{FLAGS.cache_root_dir}/metric_scores")
+        results = evaluate(FLAGS.path, FLAGS.dataset, FLAGS.lps, levels=FLAGS.levels, gold=FLAGS.gold, metrics=FLAGS.metrics, cache=cache)
+        cache.close()
+        for task, scores in results.items():
+            print(task)
+            for metric, score in scores.items():
+                print(f"{metric}\t{score:.3f}")
+        return
+
+    from mt_metrics_eval import data
+    from gemba.mtme_tools import eval_metrics
+
+    eval_sets = {}
+    for lp in FLAGS.lps:
+        print(lp, file=sys.stderr)
+        eval_sets[lp] = data.EvalSet(FLAGS.dataset, lp, True, path=FLAGS.path)
+
+    appraise_results = eval_metrics(
+        eval_sets, FLAGS.lps, ['sys'], primary_only=False, k=1000,
+        gold_name=FLAGS.gold, include_domains=False, seg_level_no_avg=True,
+        include_human_with_acc=False, engine=FLAGS.engine)
+    results = appraise_results[list(appraise_results.keys())[0]]
+
+    print(f"Accuracy results")
+    for key in results.keys():
+        print(f"{key}\t{results[key][1]:.3f}\t{results[key][0]}")
+
+
+if __name__ == "__main__":
+    app.run(main)
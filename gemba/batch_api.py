@@ -0,0 +1,116 @@
+import asyncio
+import json
+import sys
+from termcolor import colored
+from gemba.cache import cache_key
+
+
+# limits of a single batch of the OpenAI Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+
+def create_batch_files(gptapi, requests, model, temperature=0, max_tokens=None):
+    """Serializes {cache key: prompt} into JSONL batch files respecting the batch size limits."""
+    files = []
+    lines = []
+    size = 0
+    for key, prompt in requests.items():
+        line = json.dumps({
+            "custom_id": key,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": gptapi.get_parameters(prompt, model, temperature, max_tokens),
+        }, ensure_ascii=False) + "\n"
+        line = line.encode("utf-8")
+
+        if len(lines) >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_BYTES:
+            files.append(b"".join(lines))
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+
+    if len(lines) > 0:
+        files.append(b"".join(lines))
+    return files
+
+
+def parse_batch_output(content):
+    """
+    Yields (cache key, answers) of the successful requests in a batch output file.
+
+    Answers are in the same format as returned by GptApi.request_api. Requests with a truncated or empty
+    answer are skipped, they are left to the live requests with their max_tokens escalation.
+    """
+    for line in content.splitlines():
+        if line.strip() == "":
+            continue
+        result = json.loads(line)
+        response = result.get("response")
+        if result.get("error") is not None or response is None or response.get("status_code") != 200:
+            continue
+
+        answers = []
+        for choice in response["body"]["choices"]:
+            content = choice["message"]["content"]
+            if content is None or choice["finish_reason"] != "stop":
+                answers = []
+                break
+            answers.append({
+                "answer": content.strip(),
+                "finish_reason": choice["finish_reason"],
+            })
+
+        if len(answers) > 0:
+            yield result["custom_id"], answers
+
+
+async def run_batch(gptapi, prompts, model, cache, temperature=0, max_tokens=None, poll_interval=60):
+    """
+    Requests all uncached prompts through the Batch API, stores the answers in the cache and returns their count.
+
+    Prompts which are answered afterwards are resolved from the cache by GptApi.bulk_request. Those missing
+    from the batch output or failing to parse go through the usual live requests.
+    """
+    requests = {}
+    keys = [cache_key(model, temperature, prompt) for prompt in prompts]
+    for key, prompt, answers in zip(keys, prompts, await cache.aget_many(keys)):
+        if answers is None or len(answers) == 0:
+            requests[key] = prompt
+
+    if len(requests) == 0:
+        return 0
+
+    client = gptapi.client
+    batches = []
+    for data in create_batch_files(gptapi, requests, model, temperature, max_tokens):
+        batch_file = await client.files.create(file=("gemba_batch.jsonl", data), purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"Submitted batch {batch.id}", file=sys.stderr)
+        batches.append(batch)
+
+    answered = 0
+    for batch in batches:
+        while batch.status in ["validating", "in_progress", "finalizing", "cancelling"]:
+            await asyncio.sleep(poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+            if batch.request_counts is not None:
+                print(f"Batch {batch.id}: {batch.status}, {batch.request_counts.completed}/{batch.request_counts.total} completed", file=sys.stderr)
+
+        if batch.status != "completed":
+            print(colored(f"Batch {batch.id} ended with status {batch.status}.", "red"), file=sys.stderr)
+        # expired and cancelled batches may still contain partial results
+        if batch.output_file_id is None:
+            continue
+
+        content = await client.files.content(batch.output_file_id)
+        for key, answers in parse_batch_output(content.text):
+            if key in requests:
+                cache[key] = answers
+                answered += 1
+
+    gptapi.stats["batch_requests"] += len(requests)
+    gptapi.stats["batch_answers"] += answered
+    print(f"Batch API answered {answered} of {len(requests)} requests", file=sys.stderr)
+    return answered
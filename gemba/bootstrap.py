@@ -0,0 +1,181 @@
+import zlib
+import numpy as np
+from gemba import meta_eval
+
+######
+# Paired bootstrap significance tests of metric correlations, vectorized over all resamples and metrics.
+# Fast approximation of data.CompareMetrics and data.CompareMetricsWithGlobalAccuracy of mt-metrics-eval, which
+# run permutation tests instead, so significance clusters and ranks can differ.
+######
+
+SEED = 1234
+
+# upper bound of the floats materialized per chunk of resamples
+CHUNK_FLOATS = 2 * 10 ** 7
+
+
+def to_arrays(corrs):
+    """
+    Converts {metric: stats.Correlation} into (metric names, gold matrix, metric matrices), None becomes NaN.
+    Matrices are (number of systems, number of items) as scores are stored system by system.
+    """
+    names = list(corrs.keys())
+    first = corrs[names[0]]
+    num_sys = first.num_sys
+    gold = np.array([np.nan if x is None else x for x in first.gold_scores], dtype=np.float64).reshape(num_sys, -1)
+    metrics = np.array([[np.nan if x is None else x for x in corrs[m].metric_scores] for m in names], dtype=np.float64)
+    return names, gold, metrics.reshape(len(names), num_sys, -1)
+
+
+def task_seed(name, seed=SEED):
+    # stable across processes, unlike hash()
+    return seed + zlib.crc32(str(name).encode("utf-8"))
+
+
+def correlate(corr, gold, metrics):
+    if corr == "pearson":
+        return meta_eval.pearson(gold, metrics)
+    elif corr == "kendall":
+        return meta_eval.kendall(gold, metrics)
+    raise Exception(f"Correlation {corr} not supported.")
+
+
+def bootstrap_correlations(gold, metrics, corr, average_by, k, seed):
+    """
+    Correlations of k paired bootstrap resamples, (m, k). Items are resampled, at the system level where there
+    is one item per system the systems are resampled instead.
+    """
+    if gold.shape[1] == 1:
+        gold, metrics = gold.T, np.swapaxes(metrics, -1, -2)
+    num_units = gold.shape[1]
+    resamples = np.random.default_rng(seed).integers(0, num_units, size=(k, num_units))
+
+    if average_by == "item":
+        # the average over items only needs the correlation of every item once
+        per_item = correlate(corr, gold.T, np.swapaxes(metrics, -1, -2))
+        with np.errstate(invalid="ignore"):
+            return np.nanmean(per_item[:, resamples], axis=-1)
+
+    # Kendall sorts and ranks in several arrays of the size of the inputs
+    chunk = max(1, CHUNK_FLOATS // (metrics.size * (8 if corr == "kendall" else 1)))
+    result = []
+    for start in range(0, k, chunk):
+        indices = resamples[start:start + chunk]
+        # (chunk, num_sys, num_units) and (m, chunk, num_sys, num_units)
+        resampled_gold = np.moveaxis(gold[:, indices], 1, 0)
+        resampled_metrics = np.moveaxis(metrics[:, :, indices], 2, 1)
+        with np.errstate(invalid="ignore"):
+            result.append(meta_eval.correlation(resampled_gold, resampled_metrics, corr, average_by))
+    return np.concatenate(result, axis=1)
+
+
+def assign_ranks(sig_matrix, pval):
+    """Ranks of metrics sorted by decreasing correlation, a new rank starts when a metric is significantly worse than one of the current rank."""
+    ranks = []
+    current_rank = 1
+    start_of_rank = 0
+    for i in range(len(sig_matrix)):
+        for j in range(start_of_rank, i):
+            if sig_matrix[j, i] < pval:
+                current_rank += 1
+                start_of_rank = i
+                break
+        ranks.append(current_rank)
+    return ranks
+
+
+def significance(observed, resampled, names, pval):
+    """
+    Sorts metrics by decreasing score, returns ({name: (score, rank)}, sig matrix) where sig[i, j] is the p-value
+    of metric i not being better than metric j. Without resamples all p-values are 0 as in mt-metrics-eval.
+    """
+    order = sorted(range(len(names)), key=lambda i: -np.nan_to_num(observed[i], nan=-np.inf))
+    if resampled is None:
+        sig_matrix = np.zeros((len(order), len(order)))
+    else:
+        resampled = resampled[order]
+        # paired bootstrap: fraction of the resamples in which the better metric is not better
+        deltas = resampled[:, None, :] - resampled[None, :, :]
+        sig_matrix = np.mean(~(deltas > 0), axis=-1)
+        sig_matrix[np.tril_indices(len(order))] = 0
+    ranks = assign_ranks(sig_matrix, pval)
+    metrics = {names[i]: (observed[i], rank) for i, rank in zip(order, ranks)}
+    return metrics, sig_matrix
+
+
+def compare_metrics(names, gold, metrics, corr, average_by="none", k=1000, pval=0.05, seed=SEED):
+    """Paired bootstrap counterpart of data.CompareMetrics, returns (metrics {name: (corr, rank)}, sig_matrix)."""
+    with np.errstate(invalid="ignore"):
+        observed = meta_eval.correlation(gold, metrics, corr, average_by)
+    resampled = bootstrap_correlations(gold, metrics, corr, average_by, k, seed) if k > 0 else None
+    return significance(observed, resampled, names, pval)
+
+
+def pairwise_agreement(gold, metrics, resamples=None):
+    """
+    Number of agreeing and all system pairs of gold (num_sys,) and metrics (m, num_sys), or of each resample
+    of systems (k, num_sys) as ((m, k), (k,)). Ties agree only with ties, pairs of a system with itself don't count.
+    """
+    g = np.sign(gold[:, None] - gold[None, :])
+    x = np.sign(metrics[:, :, None] - metrics[:, None, :])
+    upper = np.triu(np.ones(g.shape, dtype=bool), 1)
+    if resamples is None:
+        return (x == g)[:, upper].sum(axis=-1), upper.sum()
+
+    a, b = np.triu_indices(resamples.shape[1], 1)
+    first, second = resamples[:, a], resamples[:, b]
+    counted = first != second
+    agree = (x[:, first, second] == g[first, second]) & counted
+    return agree.sum(axis=-1), counted.sum(axis=-1)
+
+
+def compare_metrics_global_accuracy(lp_arrays, k=1000, pval=0.05, seed=SEED):
+    """
+    Paired bootstrap counterpart of data.CompareMetricsWithGlobalAccuracy. lp_arrays are (names, sys gold, sys metrics) per
+    language pair, only metrics present in all of them are compared. Systems are resampled per language pair.
+    """
+    names = [name for name in lp_arrays[0][0] if all(name in lp_names for lp_names, _, _ in lp_arrays)]
+    rng = np.random.default_rng(seed)
+
+    agree, total = 0, 0
+    resampled_agree, resampled_total = 0, 0
+    for lp_names, gold, metrics in lp_arrays:
+        gold = gold.reshape(-1)
+        metrics = metrics.reshape(len(lp_names), -1)[[lp_names.index(name) for name in names]]
+        lp_agree, lp_total = pairwise_agreement(gold, metrics)
+        agree, total = agree + lp_agree, total + lp_total
+        if k > 0:
+            resamples = rng.integers(0, len(gold), size=(k, len(gold)))
+            lp_agree, lp_total = pairwise_agreement(gold, metrics, resamples)
+            resampled_agree, resampled_total = resampled_agree + lp_agree, resampled_total + lp_total
+
+    observed = agree / total
+    resampled = None
+    if k > 0:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            resampled = resampled_agree / resampled_total
+    return significance(observed, resampled, names, pval)
+
+
+def cross_check(corrs, corr_fcn, corr, average_by="none", k=1000, pval=0.05, tolerance=1e-6, sig_tolerance=0.05):
+    """
+    Compares compare_metrics with data.CompareMetrics on {metric: stats.Correlation}, returns the metrics
+    whose correlation or p-values differ by more than the tolerances.
+    """
+    from mt_metrics_eval import data
+    expected, expected_sig = data.CompareMetrics(corrs, corr_fcn, average_by=average_by, k=k, pval=pval)
+    names, gold, metrics = to_arrays(corrs)
+    actual, actual_sig = compare_metrics(names, gold, metrics, corr, average_by=average_by, k=k, pval=pval)
+
+    differences = []
+    expected_order = list(expected.keys())
+    actual_order = list(actual.keys())
+    for name in expected_order:
+        if abs(expected[name][0] - actual[name][0]) > tolerance:
+            differences.append((name, "corr", expected[name][0], actual[name][0]))
+    if k > 0 and expected_order == actual_order:
+        for i in range(len(expected_order)):
+            for j in range(i + 1, len(expected_order)):
+                if abs(expected_sig[i][j] - actual_sig[i][j]) > sig_tolerance:
+                    differences.append(((expected_order[i], expected_order[j]), "pval", expected_sig[i][j], actual_sig[i][j]))
+    return differences
@@ -0,0 +1,273 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import diskcache as dc
+from gemba.gemba_mqm_utils import ChatPrompt
+
+
+def open_disk_cache(directory):
+    return dc.Cache(directory, expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
+
+
+def open_cache(directory):
+    return TieredCache(directory)
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def get_cache(directory):
+    """Cache of directory shared by all calls in the process, it is closed at exit."""
+    directory = os.path.abspath(directory)
+    with _shared_caches_lock:
+        cache = _shared_caches.get(directory)
+        if cache is None or cache.closed:
+            cache = _shared_caches[directory] = open_cache(directory)
+        return cache
+
+
+def cache_key(model, temperature, prompt):
+    """Fixed-size key of a request, a digest of its canonical JSON serialization."""
+    if isinstance(prompt, ChatPrompt):
+        # identical to the key of the rendered list of turns
+        serialized = '{"model":' + json.dumps(model, ensure_ascii=False) + ',"prompt":' + prompt.to_json() + ',"temperature":' + json.dumps(temperature) + '}'
+    else:
+        request = {"model": model, "temperature": temperature, "prompt": prompt}
+        serialized = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def is_legacy_key(key):
+    # caches written before digest keys used the request dict itself as the key
+    return isinstance(key, dict) and set(key.keys()) == {"model", "temperature", "prompt"}
+
+
+def migrate_cache(cache, batch_size=1000):
+    """
+    Rewrites legacy request dict keys to digest keys in place and returns the number of migrated entries.
+
+    Entries are moved in batched transactions, an interrupted migration can simply be started again.
+    """
+    migrated = 0
+    batch = []
+
+    def move(batch):
+        with cache.transact():
+            for key in batch:
+                answers = cache.get(key)
+                new_key = cache_key(key["model"], key["temperature"], key["prompt"])
+                # don't overwrite answers already stored under the new key
+                if new_key not in cache:
+                    cache[new_key] = answers
+                del cache[key]
+
+    # digest keys are stored as text which SQLite sorts before the pickled legacy keys,
+    # so the entries added during the migration are never visited again
+    for key in cache.iterkeys():
+        if not is_legacy_key(key):
+            continue
+        batch.append(key)
+        if len(batch) >= batch_size:
+            move(batch)
+            migrated += len(batch)
+            batch = []
+            print(f"Migrated {migrated} entries of {cache.directory}", file=sys.stderr)
+
+    if len(batch) > 0:
+        move(batch)
+        migrated += len(batch)
+
+    return migrated
+
+
+_STOP = object()
+_MISSING = object()
+
+
+class TieredCache:
+    """
+    Cache of API answers with a bounded in-process LRU in front of the diskcache.
+
+    Disk reads of the async methods run in a thread pool and writes are committed by a background thread in
+    batched transactions (write-behind), so no SQLite call blocks the event loop. Pending writes are flushed
+    on close(), at interpreter shutdown and on SIGINT/SIGTERM.
+    """
+
+    def __init__(self, directory, lru_size=100000, batch_size=500, flush_interval=1.0):
+        self.directory = directory
+        self.disk = open_disk_cache(directory)
+        self.lru = OrderedDict()
+        # the cache may be used from several event loop threads
+        self.lru_lock = threading.Lock()
+        self.lru_size = lru_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # answers already accepted but not yet committed to disk
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-reader")
+        self.writer = threading.Thread(target=self._write_behind, name="cache-writer", daemon=True)
+        self.writer.start()
+        self.closed = False
+
+        atexit.register(self.close)
+        install_signal_handlers()
+
+    def _remember(self, key, value):
+        with self.lru_lock:
+            self.lru[key] = value
+            self.lru.move_to_end(key)
+            if len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def _get_memory(self, key):
+        with self.lru_lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                return True, self.lru[key]
+        with self.pending_lock:
+            if key in self.pending:
+                return True, self.pending[key]
+        return False, None
+
+    def get(self, key, default=None):
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        value = self.disk.get(key, default)
+        if value is not default:
+            self._remember(key, value)
+        return value
+
+    async def aget(self, key, default=None):
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        value = await asyncio.get_running_loop().run_in_executor(self.readers, self.disk.get, key, default)
+        if value is not default:
+            self._remember(key, value)
+        return value
+
+    async def aget_many(self, keys):
+        """Looks up many keys in a single pass off the event loop, None for misses."""
+        values = [self._get_memory(key) for key in keys]
+        missing = [key for key, (found, _) in zip(keys, values) if not found]
+
+        def read_disk():
+            return [self.disk.get(key) for key in missing]
+
+        from_disk = iter(await asyncio.get_running_loop().run_in_executor(self.readers, read_disk))
+        result = []
+        for key, (found, value) in zip(keys, values):
+            if not found:
+                value = next(from_disk)
+                if value is not None:
+                    self._remember(key, value)
+            result.append(value)
+        return result
+
+    def iterkeys(self):
+        """Keys of the answers waiting for the write-behind first, then those on disk."""
+        with self.pending_lock:
+            pending = list(self.pending)
+        yield from pending
+        pending = set(pending)
+        for key in self.disk.iterkeys():
+            if key not in pending:
+                yield key
+
+    def __contains__(self, key):
+        found, _ = self._get_memory(key)
+        return found or key in self.disk
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value):
+        assert not self.closed, f"Cache {self.directory} is closed."
+        self._remember(key, value)
+        with self.pending_lock:
+            self.pending[key] = value
+        self.queue.put(key)
+
+    def _write_behind(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                with self.pending_lock:
+                    items = {key: self.pending[key] for key in batch if key is not _STOP and key in self.pending}
+                with self.disk.transact():
+                    for key, value in items.items():
+                        self.disk.set(key, value)
+                with self.pending_lock:
+                    for key, value in items.items():
+                        # the key may have been written again in the meantime
+                        if self.pending.get(key) is value:
+                            del self.pending[key]
+            except Exception as e:
+                print(f"Error writing to cache {self.directory}: {e}", file=sys.stderr)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if batch[-1] is _STOP:
+                return
+
+    def flush(self):
+        """Blocks until all pending answers are committed to disk."""
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.writer.join()
+        self.readers.shutdown()
+        self.disk.close()
+        atexit.unregister(self.close)
+
+
+_signal_handlers_installed = False
+
+
+def install_signal_handlers():
+    """
+    Turns SIGTERM into a regular exit so atexit flushes the caches, SIGINT already raises KeyboardInterrupt.
+    Only possible from the main thread, caches opened in other threads rely on it being called there.
+    """
+    global _signal_handlers_installed
+    if _signal_handlers_installed or threading.current_thread() is not threading.main_thread():
+        return
+    _signal_handlers_installed = True
+
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
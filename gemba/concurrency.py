@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limiter of the number of API requests in flight.
+
+    It starts with a slow start phase (the limit grows by one with every successful request, i.e. doubles
+    every round trip) until the first overload is seen. After that the limit grows additively by roughly
+    one per round trip. Growth is paused while the latency is above `latency_tolerance` times the best latency
+    seen so far. On overload (429, 5xx, timeouts) the limit is multiplied by `backoff_ratio`, at most once
+    per round trip so a burst of failures from a single overloaded window doesn't collapse it to the minimum.
+    """
+
+    def __init__(self, min_limit=1, max_limit=800, initial_limit=None, backoff_ratio=0.5, latency_tolerance=2.0):
+        assert 1 <= min_limit <= max_limit, "Concurrency bounds must satisfy 1 <= min_limit <= max_limit."
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        if initial_limit is None:
+            initial_limit = min(max(min_limit, 16), max_limit)
+        self.limit = float(initial_limit)
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.slow_start = True
+        self.min_latency = None
+        self.latency = None  # exponentially weighted moving average
+        self.last_backoff = 0
+
+        self._loop = None
+        self._condition = None
+
+    def _get_condition(self):
+        # asyncio primitives are bound to a loop, recreate them when the limiter is used from a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency=None, overloaded=False):
+        """Latency of a successful request grows the limit, an overloaded request shrinks it."""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if overloaded:
+                self._on_overload()
+            elif latency is not None:
+                self._on_success(latency)
+            # wake only as many waiters as there are free slots
+            condition.notify(max(0, int(self.limit) - self.in_flight))
+
+    def _on_success(self, latency):
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+
+        if self.latency > self.latency_tolerance * self.min_latency:
+            return
+
+        if self.slow_start:
+            self.limit += 1
+        else:
+            self.limit += 1 / self.limit
+        self.limit = min(self.limit, self.max_limit)
+
+    def _on_overload(self):
+        self.slow_start = False
+        now = time.monotonic()
+        round_trip = self.latency if self.latency is not None else 1
+        if now - self.last_backoff < round_trip:
+            return
+        self.last_backoff = now
+        self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
@@ -1,8 +1,8 @@
-import diskcache as dc
 from gemba.prompt import prompts, language_codes
 from gemba.gpt_api import GptApi
 from gemba.testset import Testset
 from gemba.scores import Scores
+from gemba.cache import open_cache
 
 
 def main():
@@ -15,7 +15,7 @@ def main():
     for scenario in scenarios:
         use_model = scenario[0]
         annotation = scenario[1]
-        cache = dc.Cache(f'cache/{use_model}_{annotation}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
+        cache = open_cache(f'cache/{use_model}_{annotation}')
 
         scoring_name = f"{annotation}_{use_model}"
 
@@ -38,7 +38,7 @@ def main():
             for src, hyp, ref, system in testset.iterate_over_all(refname):
                 hypothesis_index += 1
 
-                if scores.get_score(system, hypothesis_index) != 'None':
+                if scores.get_score(system, hypothesis_index) is not None:
                     continue
 
                 print(f"Processing hypothesis {hypothesis_index}/{total} for {scoring_name} on {dataset}/{lp}")
@@ -1,21 +1,66 @@
-import ipdb
 import json
 import re
+import string
 from collections import defaultdict
 
+class ChatPrompt:
+    """
+    Chat prompt of a few-shot template: the leading turns without placeholders are shared by all rows of the
+    template, only the remaining turns are formatted per row. render() gives the usual list of turns.
+    """
+    __slots__ = ["prefix", "turns"]
+
+    def __init__(self, prefix, turns):
+        self.prefix = prefix
+        self.turns = turns
+
+    def render(self):
+        return list(self.prefix.turns) + list(self.turns)
+
+    def to_json(self):
+        # same as json.dumps(self.render(), ...) used for cache keys, the prefix is serialized only once
+        turns = [json.dumps(turn, sort_keys=True, ensure_ascii=False, separators=(",", ":")) for turn in self.turns]
+        return "[" + ",".join(([self.prefix.json] if self.prefix.turns else []) + turns) + "]"
+
+
+class PromptPrefix:
+    def __init__(self, turns):
+        self.turns = tuple(turns)
+        self.json = ",".join(json.dumps(turn, sort_keys=True, ensure_ascii=False, separators=(",", ":")) for turn in self.turns)
+
+
+# shared prefix of each list template, keyed by id() of the template which is kept alive in the value
+_prefixes = {}
+
+
+def get_prefix(template):
+    if id(template) not in _prefixes:
+        prefix = []
+        for turn in template:
+            if any(field is not None for _, field, _, _ in string.Formatter().parse(turn['content'])):
+                break
+            p = turn.copy()
+            p['content'] = p['content'].format()
+            prefix.append(p)
+        _prefixes[id(template)] = (template, PromptPrefix(prefix))
+    return _prefixes[id(template)][1]
+
+
 def apply_template(template, data):
     if isinstance(template, str):
         return template.format(**data)
     elif isinstance(template, list):
-        prompt = []
-        for conversation_turn in template:
+        prefix = get_prefix(template)
+        turns = []
+        for conversation_turn in template[len(prefix.turns):]:
             p = conversation_turn.copy()
             p['content'] = p['content'].format(**data)
-            prompt.append(p)
-        return prompt
+            turns.append(p)
+        return ChatPrompt(prefix, tuple(turns))
     else:
         raise ValueError(f"Unknown template type {type(template)}")
 
+
 def parse_broken_json(x):
     improved_translation = ""
     errors = defaultdict(list)
@@ -8,12 +8,51 @@ from datetime import datetime
 import openai
 from tqdm.asyncio import tqdm
 import asyncio
+from collections import Counter
+from gemba.concurrency import AdaptiveConcurrencyLimiter
+from gemba.rate_limiter import RateLimiter, estimate_prompt_tokens, DEFAULT_COMPLETION_TOKENS
+from gemba.retry import RetryPolicy, CircuitBreaker, get_retry_after, MAX_TEMPERATURE, retry_samples_at, next_temperature, parse_raw_answer, select_answer
+from gemba.cache import cache_key
+from gemba.batch_api import run_batch
+from gemba.token_budget import TokenBudget
+from gemba.gemba_mqm_utils import ChatPrompt
+
+
+def is_overload_error(e):
+    # errors signalling that the endpoint can't keep up with the current load
+    if isinstance(e, (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    status_code = getattr(e, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
 
 
 # class for calling OpenAI API and handling cache
 class GptApi:
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, min_concurrency=1, max_concurrency=800, rate_limits=None, max_attempts=10, batch=False, batch_poll_interval=60,
+                 retry_strategy="escalate", retry_samples=5, retry_temperature=5):
         self.verbose = verbose
+        # unparseable answers are retried either with increasing temperature one call at a time ("escalate")
+        # or with retry_samples answers sampled at retry_temperature in a single call ("sample")
+        assert retry_strategy in ["escalate", "sample"], f"Unknown retry strategy {retry_strategy}."
+        self.retry_strategy = retry_strategy
+        self.retry_samples = retry_samples
+        self.retry_temperature = retry_temperature
+        # request uncached prompts of bulk_request through the Batch API first
+        self.batch = batch
+        self.batch_poll_interval = batch_poll_interval
+        # limits the number of requests in flight, adapting to the endpoint between the bounds
+        self.limiter = AdaptiveConcurrencyLimiter(min_limit=min_concurrency, max_limit=max_concurrency)
+        # requests and tokens per minute for each model/deployment, e.g. {"gpt-4": {"rpm": 480, "tpm": 80000}}
+        self.rate_limits = rate_limits if rate_limits is not None else {}
+        self.rate_limiters = {}
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts)
+        # shared by all requests, pauses them all when the endpoint is down
+        self.circuit_breaker = CircuitBreaker()
+        self.stats = Counter()
+        # max_tokens of named stages learned from the lengths of their answers
+        self.token_budget = TokenBudget()
+        # futures of API requests in flight, identical concurrent requests share one of them
+        self.in_flight = {}
 
         if "OPENAI_AZURE_ENDPOINT" in os.environ:
             assert "OPENAI_AZURE_KEY" in os.environ, "OPENAI_AZURE_KEY not found in environment"
@@ -23,37 +62,86 @@ class GptApi:
                 api_key=os.environ["OPENAI_AZURE_KEY"],
                 azure_endpoint=os.environ["OPENAI_AZURE_ENDPOINT"],
                 api_version="2023-07-01-preview",
-                timeout=6000
+                timeout=6000,
+                max_retries=0  # retries are handled by self.retry_policy
             )
         elif "OPENAI_API_KEY" in os.environ:
             # OpenAI API access
             self.client = openai.AsyncOpenAI(
                 api_key=os.getenv("OPENAI_API_KEY"),
                 base_url=os.getenv("OPENAI_BASE_URL"),
-                timeout=6000
+                timeout=6000,
+                max_retries=0  # retries are handled by self.retry_policy
             )
         else:
             raise Exception("OPENAI_API_KEY or OPENAI_AZURE_KEY not found in environment")
 
         logging.getLogger().setLevel(logging.CRITICAL)  # in order to suppress all these HTTP INFO log messages
 
+    def print_stats(self):
+        if len(self.stats) > 0:
+            print("Run statistics: " + ", ".join(f"{key}={value}" for key, value in sorted(self.stats.items())), file=sys.stderr)
+
+    def get_rate_limiter(self, model):
+        if model not in self.rate_limits:
+            return None
+        if model not in self.rate_limiters:
+            limits = self.rate_limits[model]
+            self.rate_limiters[model] = RateLimiter(limits.get("rpm"), limits.get("tpm"))
+        return self.rate_limiters[model]
+
     # answer_id is used for determining if it was the top answer or how deep in the list it was
-    async def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None):
-        request = {"model": model, "temperature": temperature, "prompt": prompt}
+    async def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, prompt_id=None):
+        n = retry_samples_at(temperature, self.retry_strategy, self.retry_samples)
+        key = cache_key(model, temperature, prompt)
+        # answers reference their prompt by the key of its first request
+        if prompt_id is None:
+            prompt_id = key if temperature == 0 else cache_key(model, 0, prompt)
 
-        if request in cache and cache[request] is not None and len(cache[request]) > 0:
-            answers = cache[request]
-        else:
-            answers = await self.request_api(prompt, model, temperature, max_tokens)
-            cache[request] = answers
+        answers = await cache.aget(key)
+        if answers is None or len(answers) == 0:
+            answers = await self.fetch(key, prompt, model, temperature, max_tokens, cache, n=n)
+
+        parsed_answers = self.parse_answers(answers, prompt_id, model, parse_response, temperature, answer_id)
+
+        # there was no valid answer, increase temperature and try again
+        if len(parsed_answers) == 0:
+            answer_id += len(answers)
+            self.stats["parse_retries"] += 1
+            return await self.request(prompt, model, parse_response, temperature=next_temperature(temperature, self.retry_strategy, self.retry_temperature),
+                                      answer_id=answer_id, cache=cache, max_tokens=max_tokens, prompt_id=prompt_id)
+
+        return select_answer(parsed_answers)
 
+    async def fetch(self, key, prompt, model, temperature, max_tokens, cache, n=1):
+        """Calls the API and caches the answers, identical requests already in flight are awaited instead."""
+        flight_key = (id(cache), key)
+        if flight_key in self.in_flight:
+            self.stats["coalesced_requests"] += 1
+            return await asyncio.shield(self.in_flight[flight_key])
+
+        future = asyncio.ensure_future(self.request_api(prompt, model, temperature, max_tokens, n=n))
+        self.in_flight[flight_key] = future
+
+        def done(future):
+            del self.in_flight[flight_key]
+            # cache even when the requesting coroutine was cancelled in the meantime
+            if not future.cancelled() and future.exception() is None:
+                cache[key] = future.result()
+
+        future.add_done_callback(done)
+        # shielded so that cancelling one of the waiters doesn't cancel the request for the others
+        return await asyncio.shield(future)
+
+    def parse_answers(self, answers, prompt_id, model, parse_response, temperature=0, answer_id=-1):
+        """Parses raw answers, an empty list means that none of them was valid and a retry is needed."""
         # there is no valid answer
         if len(answers) == 0:
             return [{
                     "temperature": temperature,
                     "answer_id": answer_id,
                     "answer": None,
-                    "prompt": prompt,
+                    "prompt_id": prompt_id,
                     "finish_reason": None,
                     "model": model,
                     }]
@@ -61,40 +149,77 @@ class GptApi:
         parsed_answers = []
         for full_answer in answers:
             finish_reason = full_answer["finish_reason"]
+            completion_tokens = full_answer.get("completion_tokens")
             full_answer = full_answer["answer"]
             answer_id += 1
-            answer = parse_response(full_answer)
+            kept, answer = parse_raw_answer(full_answer, finish_reason, parse_response)
             if self.verbose or temperature > 0:
                 print(f"Answer (t={temperature}): " + colored(answer, "yellow") + " (" + colored(full_answer, "blue") + ")", file=sys.stderr)
-            if answer is None and finish_reason == "stop":
+            if not kept:
                 continue
             parsed_answers.append(
                 {
                     "temperature": temperature,
                     "answer_id": answer_id,
                     "full_answer": full_answer,
-                    "answer": answer if finish_reason != "length" else None,
-                    "prompt": prompt,
+                    "answer": answer,
+                    "prompt_id": prompt_id,
                     "finish_reason": finish_reason,
+                    "completion_tokens": completion_tokens,
                     "model": model,
                 }
             )
 
-        # there was no valid answer, increase temperature and try again
-        if len(parsed_answers) == 0:
-            return await self.request(prompt, model, parse_response, temperature=temperature + 1, answer_id=answer_id, cache=cache)
-
         return parsed_answers
 
-    async def request_api(self, prompt, model, temperature=0, max_tokens=None):
-        if temperature > 10:
+    async def request_api(self, prompt, model, temperature=0, max_tokens=None, n=1):
+        if temperature > MAX_TEMPERATURE:
             return []
 
+        rate_limiter = self.get_rate_limiter(model)
+        if rate_limiter is not None:
+            estimated_tokens = estimate_prompt_tokens(prompt, model) + n * (max_tokens if max_tokens is not None else DEFAULT_COMPLETION_TOKENS)
+
+        attempt = 0
         while True:
+            await self.circuit_breaker.wait()
+            error = None
             try:
-                response = await self.call_api(prompt, model, temperature, max_tokens)
+                if rate_limiter is not None:
+                    await rate_limiter.acquire(estimated_tokens)
+                await self.limiter.acquire()
+                start = time.time()
+                latency = None
+                overloaded = False
+                try:
+                    response = await self.call_api(prompt, model, temperature, max_tokens, n=n)
+                except Exception as e:
+                    error = e
+                    overloaded = is_overload_error(e)
+                else:
+                    latency = time.time() - start
+                finally:
+                    # the slot is given back also when the request is cancelled, shielded from a repeated cancellation
+                    await asyncio.shield(self.limiter.release(latency=latency, overloaded=overloaded))
+            except asyncio.CancelledError:
+                # a cancelled probe must not keep the circuit waiting for its result
+                self.circuit_breaker.record_cancelled()
+                raise
+
+            if error is None:
+                self.circuit_breaker.record_success()
+                if rate_limiter is not None and getattr(response, "usage", None) is not None:
+                    rate_limiter.reconcile(estimated_tokens, response.usage.total_tokens)
                 break
-            except Exception as e:
+            else:
+                e = error
+                retry_after = get_retry_after(e)
+                was_open = self.circuit_breaker.state == "open"
+                self.circuit_breaker.record_failure(overloaded, retry_after)
+                if not was_open and self.circuit_breaker.state == "open":
+                    self.stats["circuit_opened"] += 1
+                    print(colored("Endpoint seems to be down, pausing all requests.", "red"), file=sys.stderr)
+
                 # response was filtered
                 if hasattr(e, 'code'):
                     if e.code == 'content_filter':
@@ -103,10 +228,24 @@ class GptApi:
                 if hasattr(e, 'error') and e.error['code'] == 'invalid_model_output':
                     return []
 
+                attempt += 1
+                if attempt >= self.retry_policy.max_attempts:
+                    self.stats["failed_requests"] += 1
+                    print(colored(f"Error, giving up after {attempt} attempts.", "red"), file=sys.stderr)
+                    print(e, file=sys.stderr)
+                    return []
+
                 # frequent error is reaching the API limit
+                self.stats["retries"] += 1
+                if overloaded:
+                    self.stats["overloaded"] += 1
                 print(colored("Error, retrying...", "red"), file=sys.stderr)
                 print(e, file=sys.stderr)
-                await asyncio.sleep(1)
+                await asyncio.sleep(self.retry_policy.delay(attempt, retry_after))
+
+        # exact length of the answer for the token budget, the usage of several choices is only known in total
+        usage = getattr(response, "usage", None)
+        completion_tokens = getattr(usage, "completion_tokens", None) if len(response.choices) == 1 else None
 
         answers = []
         for choice in response.choices:
@@ -124,25 +263,33 @@ class GptApi:
                 print(f"Finish reason: {choice.finish_reason}", file=sys.stderr)
                 if max_tokens is None:
                     return []
-                if max_tokens < 1200:
-                    return await self.request_api(prompt, model, temperature=temperature, max_tokens=max_tokens + 200)
+                escalated_max_tokens = self.token_budget.escalate(max_tokens)
+                if escalated_max_tokens is not None:
+                    self.stats["truncation_retries"] += 1
+                    return await self.request_api(prompt, model, temperature=temperature, max_tokens=escalated_max_tokens, n=n)
 
             answers.append({
                 "answer": answer,
                 "finish_reason": choice.finish_reason,
             })
+            if completion_tokens is not None:
+                answers[-1]["completion_tokens"] = completion_tokens
 
         if len(answers) > 1:
-            # remove duplicate answers
-            answers = [dict(t) for t in {tuple(d.items()) for d in answers}]
+            # remove duplicate answers, keeping the order of the choices
+            answers = [dict(t) for t in dict.fromkeys(tuple(d.items()) for d in answers)]
 
         return answers
 
-    async def call_api(self, prompt, model, temperature, max_tokens):
+    async def call_api(self, prompt, model, temperature, max_tokens, n=1):
+        parameters = self.get_parameters(prompt, model, temperature, max_tokens, n=n)
+        return await self.client.chat.completions.create(**parameters)
+
+    def get_parameters(self, prompt, model, temperature, max_tokens, n=1):
         parameters = {
             "temperature": temperature/10,
             "top_p": 1,
-            "n": 1,
+            "n": n,
             "frequency_penalty": 0,
             "presence_penalty": 0,
             "stop": None,
@@ -153,6 +300,9 @@ class GptApi:
         if max_tokens is not None:
             parameters["max_tokens"] = max_tokens
 
+        if isinstance(prompt, ChatPrompt):
+            prompt = prompt.render()
+
         if isinstance(prompt, list):
             # check that prompt contain list of dictionaries with role and content
             assert all(isinstance(p, dict) for p in prompt), "Prompts must be a list of dictionaries."
@@ -165,23 +315,91 @@ class GptApi:
                 "content": prompt,
             }]
 
-        return await self.client.chat.completions.create(**parameters)
+        return parameters
 
-    async def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None):
-        max_concurrent_requests = 800
-        semaphore = asyncio.Semaphore(max_concurrent_requests)  # Limit to x concurrent requests
+    async def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None, name=None):
+        # a single stage pipeline over the prompts in df["prompt"]
+        stage = {"name": name, "prompt": lambda row: row["prompt"], "validate_answer": parse_mqm_answer, "max_tokens": max_tokens, "output": "answer"}
+        return await self.pipeline_request(df, model, [stage], cache)
 
-        async def process_row(index, row):
-            async with semaphore:
-                prompt = row["prompt"]
-                out = await self.request(prompt, model, parse_mqm_answer, cache=cache, max_tokens=max_tokens)
-                return index, out  # Return index to track order
+    async def get_max_tokens(self, stage, model, cache, stage_keys=None):
+        """
+        max_tokens of a stage, learned from the lengths of its previous answers when the stage is named. The
+        cache of a multi-stage method holds the answers of all its stages, stage_keys are then the cache keys
+        of prompts of this stage and only their answers seed the lengths.
+        """
+        if stage.get("name") is None:
+            return stage["max_tokens"]
+        await self.token_budget.seed(stage["name"], model, cache, stage_keys)
+        return self.token_budget.max_tokens(stage["name"], model, stage["max_tokens"])
 
-        tasks = [process_row(i, row) for i, row in df.iterrows()]
-        responses = [None] * len(df)
+    async def run_stages(self, row, model, stages, cache, first_stage=0):
+        """Requests the stages of a single row in order, returns the parsed answers of the last one."""
+        for stage in stages[first_stage:]:
+            prompt = stage["prompt"](row)
+            stage_keys = [cache_key(model, 0, prompt)] if len(stages) > 1 else None
+            max_tokens = await self.get_max_tokens(stage, model, cache, stage_keys)
+            answers = await self.request(prompt, model, stage["validate_answer"], cache=cache, max_tokens=max_tokens)
+            if stage.get("name") is not None and answers[0]["finish_reason"] == "stop":
+                self.token_budget.observe(stage["name"], model, answers[0]["full_answer"], answers[0].get("completion_tokens"))
+            row[stage["output"]] = answers[0]["answer"]
+        return answers
+
+    async def pipeline_request(self, df, model, stages, cache):
+        """
+        Requests a chain of stages for every row of df and returns the parsed answers of the last stage.
+
+        Each stage is a dict with "prompt" (builds the prompt from the row), "validate_answer", "max_tokens"
+        and "output", the row key receiving its parsed answer so that the following stages can use it. Stages
+        with a "name" get their max_tokens from self.token_budget, "max_tokens" is then only the initial value.
+        Rows advance independently, the next stage of a row is requested as soon as its previous one is
+        answered, all under the same concurrency limits. Outputs of intermediate stages are added to df.
+        """
+        rows = df.to_dict("records")
+        responses = [None] * len(rows)
+        # stage at which each row continues with live requests
+        first_stage = [0] * len(rows)
+
+        # resolve cache hits synchronously stage by stage, only rows with a missing stage are dispatched
+        resolved = list(range(len(rows)))
+        for stage_index, stage in enumerate(stages):
+            prompts = [stage["prompt"](rows[i]) for i in resolved]
+            keys = [cache_key(model, 0, prompt) for prompt in prompts]
+            # also seeds the lengths of the stage from the answers of its prompts before any live request
+            max_tokens = await self.get_max_tokens(stage, model, cache, keys if len(stages) > 1 else None)
+            if self.batch:
+                await run_batch(self, prompts, model, cache, max_tokens=max_tokens, poll_interval=self.batch_poll_interval)
+
+            cached_answers = await cache.aget_many(keys)
+            still_resolved = []
+            for index, key, answers in zip(resolved, keys, cached_answers):
+                if answers is None or len(answers) == 0:
+                    continue
+                parsed_answers = self.parse_answers(answers, key, model, stage["validate_answer"])
+                if len(parsed_answers) == 0:
+                    continue
+                rows[index][stage["output"]] = parsed_answers[0]["answer"]
+                first_stage[index] = stage_index + 1
+                responses[index] = parsed_answers
+                still_resolved.append(index)
+            resolved = still_resolved
+
+        misses = [i for i in range(len(rows)) if first_stage[i] < len(stages)]
+        if len(misses) < len(rows):
+            print(f"Resolved {len(rows) - len(misses)} of {len(rows)} requests from cache", file=sys.stderr)
+
+        # concurrency of the API calls is limited by self.limiter
+        async def process_row(index):
+            out = await self.run_stages(rows[index], model, stages, cache, first_stage[index])
+            return index, out  # Return index to track order
+
+        tasks = [process_row(i) for i in misses]
 
         for result in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing requests"):
             index, response = await result
             responses[index] = response
 
+        for stage in stages[:-1]:
+            df[stage["output"]] = [row.get(stage["output"]) for row in rows]
+
         return [answer for sublist in responses for answer in sublist]  # Flatten results
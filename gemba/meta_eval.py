@@ -0,0 +1,297 @@
+import fnmatch
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+######
+# Meta-evaluation of metrics over the .seg.score/.sys.score files of mt-metrics-eval with NumPy:
+# Pearson, Kendall tau-a/b/c and pairwise accuracy, all vectorized over the leading axes of the inputs.
+# Kendall counts discordant pairs by inversions, O(n log n) per bit of the ranks instead of O(n^2) pairs.
+######
+
+
+def pearson(gold, metrics):
+    """Pearson of gold (..., n) with metrics (m, ..., n) over the last axis, ignoring NaN pairs."""
+    valid = ~np.isnan(metrics) & ~np.isnan(gold)
+    count = valid.sum(axis=-1)
+    g = np.where(valid, gold, 0.0)
+    x = np.where(valid, metrics, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        g_mean = g.sum(axis=-1, keepdims=True) / count[..., None]
+        x_mean = x.sum(axis=-1, keepdims=True) / count[..., None]
+        g = np.where(valid, g - g_mean, 0.0)
+        x = np.where(valid, x - x_mean, 0.0)
+        return (g * x).sum(axis=-1) / np.sqrt((g * g).sum(axis=-1) * (x * x).sum(axis=-1))
+
+
+def count_inversions(ranks):
+    """
+    Number of pairs i < j with ranks[i] > ranks[j] in every row of non-negative integer ranks (rows, n).
+    Goes from the highest bit of the ranks to the lowest, counting per bit the pairs which first differ in it.
+    """
+    num_rows, n = ranks.shape
+    inversions = np.zeros(num_rows)
+    if ranks.size == 0:
+        return inversions
+    max_rank = int(ranks.max())
+    # int32 halves the memory traffic of the passes below
+    dtype = np.int32 if ranks.size < 2 ** 31 else np.int64
+    row_starts = np.zeros(ranks.shape, dtype=bool)
+    row_starts[:, 0] = True
+    row_starts = row_starts.ravel()
+    positions = np.arange(ranks.size, dtype=dtype)
+
+    # ranks grouped by row and by the bits above the current one, in their original order within a group
+    values = ranks.ravel().astype(dtype)
+    for bit in range(max_rank.bit_length() - 1, -1, -1):
+        prefix = values >> (bit + 1)
+        ones = (values >> bit) & 1
+        group_starts = row_starts.copy()
+        group_starts[1:] |= prefix[1:] != prefix[:-1]
+        starts = np.flatnonzero(group_starts).astype(dtype)
+        group_index = np.cumsum(group_starts, dtype=dtype) - 1
+        group_start = starts[group_index]
+
+        # a 0 bit is inverted with every preceding 1 bit of its group
+        ones_before = np.cumsum(ones, dtype=dtype) - ones
+        ones_before -= ones_before[group_start]
+        inversions += (ones_before * (1 - ones)).reshape(num_rows, n).sum(axis=1, dtype=np.float64)
+
+        # stable partition of each group by the bit, the 0 bits first
+        zeros_in_group = (np.diff(np.r_[starts, ranks.size]) - np.add.reduceat(ones, starts)).astype(dtype)
+        zeros_before = positions - group_start - ones_before
+        new_positions = group_start + np.where(ones == 1, zeros_in_group[group_index] + ones_before, zeros_before)
+        partitioned = np.empty_like(values)
+        partitioned[new_positions] = values
+        values = partitioned
+    return inversions
+
+
+def tied_pairs(*sorted_values):
+    """Number of pairs equal in all of the arrays (rows, n), which are sorted so that equal values are adjacent. NaN never ties."""
+    equal = np.ones(sorted_values[0][:, 1:].shape, dtype=bool)
+    for values in sorted_values:
+        equal &= values[:, 1:] == values[:, :-1]
+    # a run of t equal values adds 1 + 2 + ... + (t - 1) pairs
+    cumulative = np.cumsum(equal, axis=1)
+    streak = cumulative - np.maximum.accumulate(np.where(equal, 0, cumulative), axis=1)
+    return streak.sum(axis=1), equal.sum(axis=1)
+
+
+def kendall_counts(gold, metrics):
+    """
+    Pair counts of gold and metrics over the last axis, broadcast against each other and ignoring NaN pairs.
+    Returns (count, pairs, gold ties, metric ties, joint ties, concordant, discordant, distinct gold, distinct metric).
+    """
+    gold, metrics = np.broadcast_arrays(np.asarray(gold, dtype=np.float64), np.asarray(metrics, dtype=np.float64))
+    shape = gold.shape[:-1]
+    n = gold.shape[-1]
+    valid = ~np.isnan(gold) & ~np.isnan(metrics)
+    gold = np.where(valid, gold, np.nan).reshape(-1, n)
+    metrics = np.where(valid, metrics, np.nan).reshape(-1, n)
+
+    count = valid.reshape(-1, n).sum(axis=1)
+    pairs = count * (count - 1) / 2
+    # sorted by gold then metric, NaN last
+    order = np.lexsort((metrics, gold), axis=-1)
+    gold = np.take_along_axis(gold, order, axis=1)
+    metrics = np.take_along_axis(metrics, order, axis=1)
+    gold_ties, gold_equal = tied_pairs(gold)
+    joint_ties, _ = tied_pairs(gold, metrics)
+    metric_ties, metric_equal = tied_pairs(np.sort(metrics, axis=1))
+
+    # dense ranks of the metric, the NaN at the end of a row get increasing ranks above all others
+    rank_order = np.argsort(metrics, axis=1, kind="stable")
+    sorted_metrics = np.take_along_axis(metrics, rank_order, axis=1)
+    new_rank = np.ones(sorted_metrics.shape, dtype=np.int64)
+    new_rank[:, 1:] = sorted_metrics[:, 1:] != sorted_metrics[:, :-1]
+    ranks = np.empty_like(rank_order)
+    np.put_along_axis(ranks, rank_order, np.cumsum(new_rank, axis=1) - 1, axis=1)
+
+    discordant = count_inversions(ranks)
+    concordant = pairs - gold_ties - metric_ties + joint_ties - discordant
+    counts = (count, pairs, gold_ties, metric_ties, joint_ties, concordant, discordant, count - gold_equal, count - metric_equal)
+    return tuple(c.reshape(shape) for c in counts)
+
+
+def kendall(gold, metrics, variant="b"):
+    """Kendall tau-a, tau-b or tau-c (as scipy.stats.kendalltau) of gold and metrics over the last axis, ignoring NaN pairs."""
+    count, pairs, gold_ties, metric_ties, _, concordant, discordant, gold_distinct, metric_distinct = kendall_counts(gold, metrics)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if variant == "a":
+            return (concordant - discordant) / pairs
+        elif variant == "b":
+            return (concordant - discordant) / np.sqrt((pairs - gold_ties) * (pairs - metric_ties))
+        elif variant == "c":
+            distinct = np.minimum(gold_distinct, metric_distinct)
+            return 2 * (concordant - discordant) / (count ** 2 * (distinct - 1) / distinct)
+    raise Exception(f"Kendall variant {variant} not supported.")
+
+
+def pairwise_accuracy(gold, metrics):
+    """(agreeing pairs, all pairs) over the last axis, a pair agrees when both order it the same way or both tie it."""
+    _, pairs, _, _, joint_ties, concordant, _, _, _ = kendall_counts(gold, metrics)
+    return concordant + joint_ties, pairs
+
+
+def correlation(gold, metrics, corr, average_by="none", variant="b"):
+    """
+    Correlation of gold (num_sys, num_items) with metrics (..., num_sys, num_items) over all scores, averaged
+    over the correlations of each system or averaged over the correlations of each item, as in mt-metrics-eval.
+    """
+    if corr == "pearson":
+        correlate = pearson
+    elif corr == "kendall":
+        correlate = lambda g, m: kendall(g, m, variant)
+    else:
+        raise Exception(f"Correlation {corr} not supported.")
+
+    with np.errstate(invalid="ignore"):
+        if average_by == "none":
+            return correlate(gold.reshape(gold.shape[:-2] + (-1,)), metrics.reshape(metrics.shape[:-2] + (-1,)))
+        elif average_by == "sys":
+            return np.nanmean(correlate(gold, metrics), axis=-1)
+        elif average_by == "item":
+            return np.nanmean(correlate(np.swapaxes(gold, -1, -2), np.swapaxes(metrics, -1, -2)), axis=-1)
+    raise Exception(f"Averaging {average_by} not supported.")
+
+
+def read_scores(path, cache=None):
+    """
+    Reads a .seg.score or .sys.score file into {system: float array}. With a cache, the arrays are stored under
+    the path of the file and reused as long as its modification time and size don't change.
+    """
+    if cache is not None:
+        stat = os.stat(path)
+        cached = cache.get(os.path.abspath(path))
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+
+    # pandas is only imported when a file is parsed, which keeps cached runs fast to start
+    from gemba.scores import read_seg_file
+    systems, starts, values = read_seg_file(path, "score")
+    ends = starts[1:] + [len(values)]
+    scores = {system: values[start:end] for system, start, end in zip(systems, starts, ends)}
+    if cache is not None:
+        cache.set(os.path.abspath(path), (stat.st_mtime_ns, stat.st_size, scores))
+    return scores
+
+
+def human_systems(basepath, dataset, lp):
+    """Names of the human translations, which are scored as systems under the name of their reference."""
+    return {path.split(".")[-2] for path in glob.glob(f"{basepath}/{dataset}/references/{lp}.*.txt")}
+
+
+def metric_names(basepath, dataset, lp, level, metrics=None):
+    """Names of the metrics with scores of the level, only those matching any of the globs in metrics if given."""
+    suffix = f".{level}.score"
+    names = sorted(name[:-len(suffix)] for name in os.listdir(f"{basepath}/{dataset}/metric-scores/{lp}") if name.endswith(suffix))
+    if metrics is not None:
+        names = [name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in metrics)]
+    return names
+
+
+def load_scores(basepath, dataset, lp, level, gold="mqm", metrics=None, cache=None):
+    """
+    Returns the gold scores and {metric: scores} of a language pair, scores are {system: float array}.
+    Only the files of metrics matching any of the globs in metrics are read, e.g. ["GEMBA-*-refA", "BLEU-*"].
+    """
+    gold_scores = read_scores(f"{basepath}/{dataset}/human-scores/{lp}.{gold}.{level}.score", cache)
+    metric_scores = {}
+    for name in metric_names(basepath, dataset, lp, level, metrics):
+        metric_scores[name] = read_scores(f"{basepath}/{dataset}/metric-scores/{lp}/{name}.{level}.score", cache)
+    return gold_scores, metric_scores
+
+
+def to_matrices(gold_scores, metric_scores, exclude_systems=()):
+    """
+    (metric names, gold (num_sys, num_items), metrics (m, num_sys, num_items)) over the systems with gold scores
+    which are not excluded. Metrics without scores for all of these systems are left out.
+    """
+    systems = [system for system, scores in gold_scores.items()
+               if system not in exclude_systems and not np.all(np.isnan(scores))]
+    names = [name for name, scores in metric_scores.items() if all(system in scores for system in systems)]
+    gold = np.stack([gold_scores[system] for system in systems])
+    metrics = np.array([[metric_scores[name][system] for system in systems] for name in names]).reshape((len(names),) + gold.shape)
+    return names, gold, metrics
+
+
+def evaluate(basepath, dataset, lps, levels=("sys", "seg"), gold="mqm", corrs=("pearson", "kendall"),
+             averages=("none",), variant="b", include_human=False, exclude_systems=None, metrics=None, cache=None):
+    """
+    Meta-evaluates the metrics of the language pairs, all of them or those matching any of the globs in metrics.
+    Returns {task: {metric: score}} with metrics sorted by decreasing score, the first task is the pairwise
+    accuracy at the system level over all language pairs and the others are "lp level average correlation".
+    exclude_systems are {lp: systems}, e.g. the outliers. Score files are read in parallel across language pairs.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(lps) * len(levels))) as pool:
+        loaded = {(lp, level): pool.submit(load_scores, basepath, dataset, lp, level, gold, metrics, cache)
+                  for lp in lps for level in levels}
+        loaded = {key: future.result() for key, future in loaded.items()}
+
+    results = {}
+    accuracy = {}
+    for lp in lps:
+        excluded = set((exclude_systems or {}).get(lp, ()))
+        if not include_human:
+            excluded |= human_systems(basepath, dataset, lp)
+
+        for level in levels:
+            names, gold_matrix, metric_matrices = to_matrices(*loaded[(lp, level)], excluded)
+            assert len(names) > 0, f"No metric has scores of all systems of {lp} at the {level} level{'' if metrics is None else ' match ' + ','.join(metrics)}."
+            if level == "sys":
+                agree, total = pairwise_accuracy(gold_matrix[:, 0], metric_matrices[:, :, 0])
+                accuracy[lp] = dict(zip(names, zip(agree, total)))
+
+            for average_by in averages:
+                # each system has a single item at the system level
+                if level == "sys" and average_by != "none":
+                    continue
+                for corr in corrs:
+                    scores = correlation(gold_matrix, metric_matrices, corr, average_by, variant)
+                    results[f"{lp} {level} {average_by} {corr}"] = sort_scores(dict(zip(names, scores)))
+
+    if len(accuracy) > 0:
+        # only metrics scoring all language pairs
+        names = [name for name in next(iter(accuracy.values())) if all(name in lp_accuracy for lp_accuracy in accuracy.values())]
+        totals = {name: np.sum([lp_accuracy[name] for lp_accuracy in accuracy.values()], axis=0) for name in names}
+        results = {f"{','.join(accuracy.keys())} sys none accuracy": sort_scores({name: agree / total for name, (agree, total) in totals.items()}), **results}
+    return results
+
+
+def sort_scores(scores):
+    return dict(sorted(scores.items(), key=lambda item: -np.nan_to_num(item[1], nan=-np.inf)))
+
+
+def cross_check(eval_sets, basepath, dataset, lps, levels=("sys", "seg"), gold="mqm", tolerance=1e-6):
+    """
+    Compares evaluate() with eval_metrics of gemba.mtme_tools at k=0 (without significance tests).
+    Returns (task, metric, expected, actual) for every metric whose scores differ by more than the tolerance.
+    """
+    from mt_metrics_eval import data
+    from gemba.mtme_tools import eval_metrics
+
+    expected = eval_metrics(eval_sets, lps, list(levels), primary_only=False, k=0, gold_name=gold, include_domains=False)
+    exclude_systems = {lp: eval_sets[lp].outlier_sys_names for lp in lps}
+    actual = evaluate(basepath, dataset, lps, levels, gold, averages=("none", "sys", "item"), exclude_systems=exclude_systems)
+
+    tasks = [(data.MakeTaskName('wmt22', lps, None, 'sys', False, 'none', 'accuracy', 0, gold,
+                                [{eval_sets[lp].std_ref} for lp in lps], [set() for lp in lps], False, False),
+              list(actual.keys())[0], eval_sets[lps[0]])]
+    for lp in lps:
+        evs = eval_sets[lp]
+        for level in levels:
+            for average_by in ("none",) if level == "sys" else ("none", "sys", "item"):
+                for corr in "pearson", "kendall":
+                    taskname = data.MakeTaskName('wmt22', lp, None, level, False, average_by, corr, 0, gold,
+                                                 {evs.std_ref}, set(), False, primary=False)
+                    tasks.append((taskname, f"{lp} {level} {average_by} {corr}", evs))
+
+    differences = []
+    for taskname, task, evs in tasks:
+        actual_scores = {evs.DisplayName(name): score for name, score in actual[task].items()}
+        for name, (rank, score, sigs) in expected[taskname].items():
+            if name not in actual_scores or not abs(actual_scores[name] - score) <= tolerance:
+                differences.append((task, name, score, actual_scores.get(name)))
+    return differences
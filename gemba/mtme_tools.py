@@ -1,5 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
 from mt_metrics_eval import data
 import scipy
+from gemba import bootstrap
 
 ######
 # Functions in this script are copied from mt-metrics-eval/wmt22_metrics.ipynb
@@ -8,7 +10,8 @@ import scipy
 
 def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                  include_domains=True, seg_level_no_avg=False,
-                 include_human_with_acc=False):
+                 include_human_with_acc=False, engine='mtme', workers=None,
+                 verbose=False):
     """Evaluate all metrics for eval sets, across multiple task settings.
 
     Args:
@@ -25,11 +28,21 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
       seg_level_no_avg: If True, use only the average_by=None setting for segment-
         level correlations
       include_human_with_acc: If True, include human outputs in accuracy tasks.
+      engine: 'mtme' runs the permutation tests of mt-metrics-eval, 'numpy'
+        the vectorized paired bootstrap of gemba.bootstrap with fixed seeds per
+        task, a faster approximation whose clusters and ranks can differ.
+      workers: Number of processes the tasks run in, defaults to the number of
+        CPUs.
+      verbose: Print the name of each task.
 
     Returns:
       Map from task names to metric -> (rank, corr, sig_string) stats.
     """
+    assert engine in ('mtme', 'numpy'), f"Engine {engine} not supported."
     results = {}
+    # independent tasks, run in a process pool at the end
+    tasks = []
+    display_names = {}
 
     # First task is global accuracy, iff more than one language is given.
     if len(langs) > 0:
@@ -45,7 +58,23 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
             taskname = data.MakeTaskName(
                 'wmt22', langs, None, 'sys', human, 'none', 'accuracy', k, gold,
                 main_refs, close_refs, False, primary_only)
-            print(taskname)
+            if verbose:
+                print(taskname)
+            if engine == 'numpy':
+                lp_arrays = []
+                for evs, lp_main_refs, lp_close_refs in zip(evs_list, main_refs, close_refs):
+                    corrs = data.GetCorrelations(
+                        evs=evs, level='sys', main_refs=lp_main_refs,
+                        close_refs=lp_close_refs, include_human=human,
+                        include_outliers=False, gold_name=gold,
+                        primary_metrics=primary_only, domain=None)
+                    corrs = {evs.DisplayName(m): v for m, v in corrs.items()}
+                    lp_arrays.append(bootstrap.to_arrays(corrs))
+                tasks.append((taskname, 'accuracy', (lp_arrays,),
+                              dict(k=k, pval=0.05, seed=bootstrap.task_seed(taskname))))
+                # keep the order of the tasks in the results
+                results[taskname] = None
+                continue
             res = data.CompareMetricsWithGlobalAccuracy(
                 evs_list, main_refs, close_refs, include_human=human,
                 include_outliers=False, gold_name=gold,
@@ -61,33 +90,65 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
         for domain in [None] + (list(evs.domain_names) if include_domains else []):
             for level in levels:
                 gold = evs.StdHumanScoreName(level) if gold_name == 'std' else gold_name
+                # correlation inputs don't depend on the averaging or correlation function
+                inputs = {}
                 for avg in 'none', 'sys', 'item':
                     if (level == 'sys' or seg_level_no_avg) and avg != 'none':
                         continue
                     for human in True, False:
                         if human == True and len(evs.ref_names) == 1:
                             continue  # Single ref
-                        for corr in 'pearson', 'kendall':
-                            corr_fcn = {'pearson': scipy.stats.pearsonr,
-                                        'kendall': scipy.stats.kendalltau}[corr]
-                            taskname = data.MakeTaskName(
-                                'wmt22', lp, domain, level, human, avg, corr, k, gold,
-                                main_refs, close_refs, False, primary=primary_only)
-                            print(taskname)
+                        if human not in inputs:
                             corrs = data.GetCorrelations(
                                 evs=evs, level=level, main_refs={evs.std_ref},
                                 close_refs=close_refs, include_human=human,
                                 include_outliers=False, gold_name=gold_name,
                                 primary_metrics=primary_only, domain=domain)
-                            metrics, sig_matrix = data.CompareMetrics(
-                                corrs, corr_fcn, average_by=avg, k=k, pval=0.05)
-                            # Make compatible with accuracy results.
-                            metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
-                            results[taskname] = reformat((metrics, sig_matrix))
+                            inputs[human] = bootstrap.to_arrays(corrs) if engine == 'numpy' else corrs
+                        for corr in 'pearson', 'kendall':
+                            taskname = data.MakeTaskName(
+                                'wmt22', lp, domain, level, human, avg, corr, k, gold,
+                                main_refs, close_refs, False, primary=primary_only)
+                            if verbose:
+                                print(taskname)
+                            if engine == 'numpy':
+                                tasks.append((taskname, 'corr', inputs[human] + (corr,),
+                                              dict(average_by=avg, k=k, pval=0.05, seed=bootstrap.task_seed(taskname))))
+                            else:
+                                tasks.append((taskname, 'mtme', (inputs[human], corr),
+                                              dict(average_by=avg, k=k, pval=0.05)))
+                            display_names[taskname] = evs.DisplayName
+                            results[taskname] = None
+
+    for taskname, (metrics, sig_matrix) in run_tasks(tasks, workers).items():
+        if taskname in display_names:
+            # Make compatible with accuracy results.
+            metrics = {display_names[taskname](m): v for m, v in metrics.items()}
+        results[taskname] = reformat((metrics, sig_matrix))
 
     return results
 
 
+def run_task(task):
+    taskname, kind, args, kwargs = task
+    if kind == 'accuracy':
+        return bootstrap.compare_metrics_global_accuracy(*args, **kwargs)
+    elif kind == 'corr':
+        return bootstrap.compare_metrics(*args, **kwargs)
+    corrs, corr = args
+    corr_fcn = {'pearson': scipy.stats.pearsonr,
+                'kendall': scipy.stats.kendalltau}[corr]
+    return data.CompareMetrics(corrs, corr_fcn, **kwargs)
+
+
+def run_tasks(tasks, workers=None):
+    """Runs (taskname, kind, args, kwargs) tasks in a process pool, returns {taskname: result} in task order."""
+    if workers == 1 or len(tasks) <= 1:
+        return {task[0]: run_task(task) for task in tasks}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return {task[0]: result for task, result in zip(tasks, pool.map(run_task, tasks))}
+
+
 def reformat(results):
     """Reformat CompareMetrics() results to match mtme's format."""
     metrics, sig_matrix = results
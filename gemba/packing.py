@@ -0,0 +1,53 @@
+import re
+from gemba.prompt import prompts
+
+
+# methods whose prompt can be applied to several numbered segments at once
+PACKABLE_METHODS = ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-stars", "GEMBA-stars_ref", "GEMBA-classes", "GEMBA-classes_ref"]
+
+# tokens of the "<translation number>: " prefix and the line break around the answer of each packed segment
+PACKED_LINE_TOKENS = 5
+# upper bound of max_tokens of a packed request, the default per-segment max_tokens times a large pack would not
+# leave room for the prompt in the context window
+PACKED_MAX_TOKENS = 4096
+
+PACKED_INSTRUCTIONS = 'Apply these instructions to each of the following {count} numbered translations independently. Answer with exactly one line per translation in the form "<translation number>: <answer>" and nothing else.'
+
+
+def create_packed_prompt(method, rows):
+    """Builds a single prompt asking for the answers of all rows, which must share the language pair."""
+    assert method in PACKABLE_METHODS, f"Method {method} doesn't support packing."
+
+    # the instruction header is followed by the segments and the answer label of a single segment
+    header, body = prompts[method]["prompt"].split("\n\n", 1)
+    body = body.rsplit("\n", 1)[0]
+
+    prompt = header.format(**rows[0]) + "\n\n" + PACKED_INSTRUCTIONS.format(count=len(rows))
+    for i, row in enumerate(rows):
+        prompt += f"\n\nTranslation {i + 1}:\n" + body.format(**row)
+    return prompt + "\n\nAnswers:\n"
+
+
+def parse_packed_answer(x, count, validate_answer):
+    """
+    Returns the raw answer of each of the count segments, None for those missing, ambiguous or failing
+    validate_answer. It never returns None itself as packed requests are not retried with higher temperature.
+    """
+    items = [None] * count
+    seen = set()
+    for line in x.split("\n"):
+        match = re.match(r"^\s*(?:translation\s*)?(\d+)\s*[:.)-]\s*(.+?)\s*$", line, re.IGNORECASE)
+        if match is None:
+            continue
+        number = int(match.group(1)) - 1
+        if number < 0 or number >= count:
+            continue
+        if number in seen:
+            # answered twice, don't trust either
+            items[number] = None
+            continue
+        seen.add(number)
+        if validate_answer(match.group(2)) is not None:
+            items[number] = match.group(2)
+
+    return items
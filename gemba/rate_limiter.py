@@ -0,0 +1,146 @@
+import asyncio
+import json
+import math
+import time
+from gemba.gemba_mqm_utils import ChatPrompt
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# completion tokens reserved for requests without max_tokens
+DEFAULT_COMPLETION_TOKENS = 500
+
+_encoders = {}
+# token counts of shared prompt prefixes, keyed by id() of the prefix which is kept alive in the value
+_prefix_tokens = {}
+
+
+def _get_encoder(model):
+    if tiktoken is None:
+        return None
+    if model not in _encoders:
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            # unknown model or the encoding can't be downloaded, use the heuristic
+            _encoders[model] = None
+    return _encoders[model]
+
+
+def count_tokens(text, model=None):
+    encoder = _get_encoder(model)
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    # roughly four bytes per token, it overestimates English and underestimates CJK less than counting characters
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def estimate_prompt_tokens(prompt, model=None):
+    """Estimates the number of prompt tokens, exact for OpenAI models when tiktoken is installed."""
+    if isinstance(prompt, ChatPrompt):
+        # the shared prefix is counted once per model
+        key = (id(prompt.prefix), model)
+        if key not in _prefix_tokens:
+            _prefix_tokens[key] = (prompt.prefix, sum(4 + count_tokens(turn["content"], model) for turn in prompt.prefix.turns))
+        return _prefix_tokens[key][1] + sum(4 + count_tokens(turn["content"], model) for turn in prompt.turns) + 3
+    if isinstance(prompt, str):
+        prompt = [{"role": "user", "content": prompt}]
+    # every message has a few tokens of overhead for the role and separators
+    return sum(4 + count_tokens(turn["content"], model) for turn in prompt) + 3
+
+
+class TokenBucket:
+    """Bucket refilled at `per_minute` units per minute, allowing bursts of `burst_seconds` worth of units."""
+
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = max(1, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available, requests larger than the bucket wait for a full bucket."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        # the level may go negative when the actual usage is larger than estimated
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    """
+    Admits requests only when both requests-per-minute and tokens-per-minute budgets allow.
+
+    Admission is FIFO so large prompts are not starved by small ones. The token estimate used at admission
+    is reconciled with the actual usage reported by the API once the response arrives.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, burst_seconds=10):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+
+        self._loop = None
+        self._lock = None
+
+    def _get_lock(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def acquire(self, tokens):
+        async with self._get_lock():
+            while True:
+                wait = 0
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests is not None:
+                self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(tokens)
+
+    def reconcile(self, estimated_tokens, used_tokens):
+        if self.tokens is not None:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+
+def load_rate_limits(path=None, model=None, requests_per_minute=None, tokens_per_minute=None):
+    """
+    Collects per model/deployment limits, e.g. {"gpt-4": {"rpm": 480, "tpm": 80000}}.
+
+    Limits are read from the JSON file at `path`, limits given explicitly for `model` take precedence.
+    """
+    rate_limits = {}
+    if path is not None:
+        with open(path, "r") as f:
+            rate_limits = json.load(f)
+
+    if model is not None and (requests_per_minute or tokens_per_minute):
+        limits = dict(rate_limits.get(model, {}))
+        if requests_per_minute:
+            limits["rpm"] = requests_per_minute
+        if tokens_per_minute:
+            limits["tpm"] = tokens_per_minute
+        rate_limits[model] = limits
+
+    return rate_limits
@@ -0,0 +1,99 @@
+import sys
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from gemba.cache import cache_key
+from gemba.prompt import prompts
+from gemba.retry import retry_temperatures, parse_raw_answer, select_answer
+
+
+def get_parser(method, stage=0):
+    # parsers are resolved by name in the worker processes as the lambdas can't be pickled
+    from gemba.utils import method_stages
+    if method in method_stages:
+        return method_stages[method][stage]["validate_answer"]
+    return prompts[method]["validate_answer"]
+
+
+def parse_cached_answers(method, stage, cached_answers):
+    """
+    Parses the cached answers of many prompts as GptApi.request does, returns (resolved, answer) for each,
+    resolved is False when none of the answers is kept and the next temperature would be requested.
+    """
+    parse_answer = get_parser(method, stage)
+    results = []
+    for answers in cached_answers:
+        parsed_answers = []
+        for answer in answers:
+            kept, parsed = parse_raw_answer(answer["answer"], answer["finish_reason"], parse_answer)
+            if kept:
+                parsed_answers.append({"answer": parsed})
+        if len(parsed_answers) == 0:
+            results.append((False, None))
+        else:
+            results.append((True, select_answer(parsed_answers)[0]["answer"]))
+    return results
+
+
+def parse_in_pool(pool, method, stage, cached_answers, chunk_size=1000):
+    chunks = [cached_answers[i:i + chunk_size] for i in range(0, len(cached_answers), chunk_size)]
+    parse = functools.partial(parse_cached_answers, method, stage)
+    return [result for chunk in pool.map(parse, chunks) for result in chunk]
+
+
+def reparse_rows(rows, stages, method, model, cache, workers=None, retry_strategy="escalate", retry_temperature=5):
+    """
+    Scores rows from the cached raw answers of all their stages with the current parsers, without any API call.
+
+    Answers are looked up in the order GptApi.request would request them with the same retry strategy,
+    temperature 0 first and the retry temperatures while they fail to parse. Returns the answers of the last
+    stage, None where it isn't answered, and the indices of the rows which would need a live call because an
+    answer is missing.
+    """
+    answers = [None] * len(rows)
+    pending = list(range(len(rows)))
+    misses = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for stage_index, stage in enumerate(stages):
+            stage_prompts = {i: stage["prompt"](rows[i]) for i in pending}
+            resolved = []
+            for temperature in retry_temperatures(retry_strategy, retry_temperature):
+                cached_answers = [cache.get(cache_key(model, temperature, stage_prompts[i])) for i in pending]
+                found = [i for i, cached in zip(pending, cached_answers) if cached]
+                misses += [i for i, cached in zip(pending, cached_answers) if not cached]
+
+                results = parse_in_pool(pool, method, stage_index, [cached for cached in cached_answers if cached])
+                pending = []
+                for i, (is_resolved, answer) in zip(found, results):
+                    if is_resolved:
+                        rows[i][stage["output"]] = answer
+                        resolved.append(i)
+                    else:
+                        pending.append(i)
+                if len(pending) == 0:
+                    break
+
+            # no valid answer at any temperature, GptApi.request gives up the same way
+            for i in pending:
+                rows[i][stage["output"]] = None
+            pending = sorted(resolved + pending)
+
+        for i in pending:
+            answers[i] = rows[i][stages[-1]["output"]]
+
+    print(f"Reparsed {len(rows) - len(misses)} of {len(rows)} rows from the cache", file=sys.stderr)
+    return answers, sorted(misses)
+
+
+def walk_cache(cache, method, stage=0, workers=None, examples=10):
+    """Parses every answer in the cache, returns the number of entries and the raw answers which fail to parse."""
+    keys = list(cache.iterkeys())
+    cached_answers = [cache.get(key) or [] for key in keys]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = parse_in_pool(pool, method, stage, cached_answers)
+
+    failures = [answers for answers, (resolved, answer) in zip(cached_answers, results) if answer is None]
+    print(f"{len(failures)} of {len(keys)} cached entries fail to parse", file=sys.stderr)
+    for answers in failures[:examples]:
+        print(" | ".join(repr(answer["answer"]) for answer in answers), file=sys.stderr)
+    return len(keys), failures
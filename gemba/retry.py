@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def get_retry_after(e):
+    """Returns the delay in seconds requested by the Retry-After headers of a failed request, if any."""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        # HTTP date format
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# highest temperature requested for unparseable answers, request_api gives up above it
+MAX_TEMPERATURE = 10
+
+
+def retry_samples_at(temperature, retry_strategy, retry_samples):
+    """Number of answers requested at a temperature, only retries of the "sample" strategy sample several."""
+    return 1 if temperature == 0 or retry_strategy == "escalate" else retry_samples
+
+
+def next_temperature(temperature, retry_strategy, retry_temperature):
+    """Temperature of the next request when none of the answers at the current one could be parsed."""
+    if retry_strategy == "sample" and temperature < retry_temperature:
+        return retry_temperature
+    return temperature + 1
+
+
+def retry_temperatures(retry_strategy="escalate", retry_temperature=5):
+    """Temperatures of the requests of a prompt in the order they are made while its answers fail to parse."""
+    temperature = 0
+    while temperature <= MAX_TEMPERATURE:
+        yield temperature
+        temperature = next_temperature(temperature, retry_strategy, retry_temperature)
+
+
+def parse_raw_answer(full_answer, finish_reason, parse_response):
+    """
+    Parses a raw answer to (kept, answer). An unparseable complete answer isn't kept and leads to a retry at a
+    higher temperature, a truncated answer is kept with None as it didn't fit even the escalated max_tokens.
+    """
+    answer = parse_response(full_answer)
+    if answer is None and finish_reason == "stop":
+        return False, answer
+    return True, answer if finish_reason != "length" else None
+
+
+def select_answer(parsed_answers):
+    # several samples, keep the first valid one so that there is one answer per prompt
+    valid_answers = [answer for answer in parsed_answers if answer["answer"] is not None]
+    return (valid_answers or parsed_answers)[:1]
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped at `max_attempts` attempts per request."""
+
+    def __init__(self, max_attempts=10, base_delay=1, max_delay=60):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        # jitter spreads the retries of concurrent requests instead of retrying them in lockstep
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Shared circuit breaker pausing all requests when the endpoint is clearly down.
+
+    After `failure_threshold` consecutive overload failures (429, 5xx, timeouts) the circuit opens and every
+    request waits for `reset_timeout` seconds (or longer if the endpoint asked for it with Retry-After). Then a
+    single probe request is let through, its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=20, reset_timeout=30, probe_interval=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.times_opened = 0
+
+    async def wait(self):
+        while True:
+            if self.state == "closed":
+                return
+
+            now = time.monotonic()
+            if self.state == "open":
+                if now < self.open_until:
+                    await asyncio.sleep(self.open_until - now + random.uniform(0, self.probe_interval))
+                    continue
+                self.state = "half-open"
+                self.probing = False
+
+            if not self.probing:
+                self.probing = True
+                return
+            # wait for the result of the probe request
+            await asyncio.sleep(self.probe_interval)
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def record_cancelled(self):
+        # a cancelled request has no result, the next one probes instead
+        self.probing = False
+
+    def record_failure(self, overloaded, retry_after=None):
+        self.probing = False
+        if not overloaded:
+            return
+
+        self.failures += 1
+        if self.state == "half-open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.open_until = time.monotonic() + max(self.reset_timeout, retry_after or 0)
+            self.times_opened += 1
@@ -1,10 +1,60 @@
 from pathlib import Path
 import os
+import math
+import time
+import numpy as np
 import pandas as pd
 
 
+def format_value(value):
+    # missing values are written as None and whole numbers without the decimal part
+    if value is None or math.isnan(value):
+        return "None"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_mean(value):
+    if value is None or math.isnan(value):
+        return "None"
+    return repr(float(value))
+
+
+def atomic_write(path, lines):
+    # readers and crashes never see a partially written file
+    with open(f"{path}.tmp", "w") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def read_seg_file(path, column):
+    """Reads a (system, value) file into the list of systems in file order, their offsets and a float array."""
+    df = pd.read_csv(path, sep="\t", names=["system", column], index_col=False, dtype={"system": str},
+                     na_values=["None"], keep_default_na=False)
+    values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64)
+    system_column = df["system"].to_numpy()
+
+    # scores of a system are contiguous, find where each block starts
+    starts = np.flatnonzero(np.r_[True, system_column[1:] != system_column[:-1]]).tolist() if len(system_column) > 0 else []
+    systems = [system_column[start] for start in starts]
+    assert len(systems) == len(set(systems)), f"Scores of a system are not contiguous in {path}."
+    return systems, starts, values
+
+
 class Scores:
-    def __init__(self, name, testset, refname, output_path=None):
+    """
+    Segment scores of all systems of a testset, stored as one float array with a contiguous block of
+    len(testset.sources) scores per system (NaN for missing scores) and the temperatures of their answers.
+
+    Assigned scores are appended to a journal which is flushed every flush_every scores or flush_interval
+    seconds and replayed by load(), so an interrupted run resumes from its last flush. save() writes the
+    final files atomically and removes the journal.
+    """
+
+    def __init__(self, name, testset, refname, output_path=None, flush_every=100, flush_interval=10):
         self.name = name
         self.testset = testset
         self.refname = refname
@@ -13,9 +63,17 @@ class Scores:
 
         self.output_path = output_path
 
-        self.seg_scores = None
-        self.metadata = None
+        self.systems = []
+        self.offsets = {}
+        self.scores = None
+        self.temperatures = None
         self.prefix = None
+
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.journal = None
+        self.journal_buffer = []
+        self.last_flush = time.monotonic()
         self.load()
 
     def load(self):
@@ -27,32 +85,59 @@ class Scores:
         else:
             self.prefix = f"{output_folder}/{self.name}-src"
 
-        seg_scores_file = self.get_seg_path()
-        if os.path.isfile(f"{seg_scores_file}"):
-            self.seg_scores = pd.read_csv(seg_scores_file, sep="\t", names=["system", "score"], index_col=False)
-        else:
-            self.seg_scores = pd.DataFrame(columns=["system", "score"])
-
-        if os.path.isfile(f"{self.get_meta_path()}"):
-            self.metadata = pd.read_csv(self.get_meta_path(), sep="\t", names=["system", "temperature"], index_col=False)
-        else:
-            self.metadata = pd.DataFrame(columns=["system", "temperature"])
-
-        # generate placeholders for scores
         segment_count = len(self.testset.sources)
-        for system in self.testset.systems.keys():
-            if system not in self.seg_scores["system"].values:
-                # generate placeholders for scores
-                placeholder = pd.DataFrame([{"system": system, 'score': 'None'}] * segment_count)
-                self.seg_scores = pd.concat([self.seg_scores, placeholder], ignore_index=True)
-
-            if system not in self.metadata["system"].values:
-                placeholder = pd.DataFrame([{"system": system, 'temperature': 'None'}] * segment_count)
-                self.metadata = pd.concat([self.metadata, placeholder], ignore_index=True)
 
-            # check that all systems are present and have correct number of scores
-            assert len(self.seg_scores[self.seg_scores.system == system]) == segment_count
-            assert len(self.metadata[self.metadata.system == system]) == segment_count
+        # systems keep the order of an existing file, systems missing from it are appended
+        if os.path.isfile(self.get_seg_path()):
+            systems, starts, scores = read_seg_file(self.get_seg_path(), "score")
+        else:
+            systems, starts, scores = [], [], np.array([], dtype=np.float64)
+        assert all(np.diff(starts + [len(scores)]) == segment_count), f"Every system must have {segment_count} scores in {self.get_seg_path()}."
+
+        self.systems = list(systems) + [system for system in self.testset.systems.keys() if system not in systems]
+        self.offsets = {system: i * segment_count for i, system in enumerate(self.systems)}
+        self.scores = np.full(len(self.systems) * segment_count, np.nan)
+        self.scores[:len(scores)] = scores
+
+        self.temperatures = np.full(len(self.systems) * segment_count, np.nan)
+        if os.path.isfile(self.get_meta_path()):
+            meta_systems, meta_starts, temperatures = read_seg_file(self.get_meta_path(), "temperature")
+            for system, start in zip(meta_systems, meta_starts):
+                assert system in self.offsets, f"Unknown system {system} in {self.get_meta_path()}."
+                offset = self.offsets[system]
+                self.temperatures[offset:offset + segment_count] = temperatures[start:start + segment_count]
+
+        if os.path.isfile(self.get_journal_path()):
+            self.replay_journal()
+
+    def replay_journal(self):
+        replayed = 0
+        # bytes of the journal up to the end of its last complete line
+        complete = 0
+        with open(self.get_journal_path(), "rb") as f:
+            for raw_line in f:
+                line = raw_line.decode("utf-8", errors="replace")
+                fields = line.rstrip("\n").split("\t")
+                # the last line may be incomplete when the run was killed while writing it
+                if not line.endswith("\n") or len(fields) != 4:
+                    break
+                complete += len(raw_line)
+                system, index, score, temperature = fields
+                if system not in self.offsets:
+                    continue
+                index = self.offsets[system] + int(index)
+                self.scores[index] = np.nan if score == "None" else float(score)
+                self.temperatures[index] = np.nan if temperature == "None" else float(temperature)
+                replayed += 1
+
+        # new scores are appended after the last complete line, not onto the torn one where replay would stop
+        if complete < os.path.getsize(self.get_journal_path()):
+            with open(self.get_journal_path(), "r+b") as f:
+                f.truncate(complete)
+                f.flush()
+                os.fsync(f.fileno())
+            print(f"Dropped the unreadable end of {self.get_journal_path()}")
+        print(f"Replayed {replayed} scores from {self.get_journal_path()}")
 
     def get_seg_path(self):
         return f"{self.prefix}.seg.score"
@@ -66,38 +151,68 @@ class Scores:
     def get_meta_path(self):
         return f"{self.prefix}.seg.meta"
 
+    def get_journal_path(self):
+        return f"{self.prefix}.seg.journal"
+
     def _remap_index(self, system, hypothesis_index):
         # the order of systems may be different
-        # get id of the first hypothesis of the system
-        index = (self.seg_scores["system"] == system).argmax()
-        h = hypothesis_index % len(self.testset.sources)
-        return index + h
+        return self.offsets[system] + hypothesis_index % len(self.testset.sources)
 
     def get_score(self, system, hypothesis_index):
-        index = self._remap_index(system, hypothesis_index)
-        return self.seg_scores.iloc[index]['score']
+        score = self.scores[self._remap_index(system, hypothesis_index)]
+        return None if math.isnan(score) else float(score)
 
     def assign_score(self, system, hypothesis_index, answer, temperature=None):
         index = self._remap_index(system, hypothesis_index)
-        self.seg_scores.iloc[index]['score'] = answer
-        self.metadata.iloc[index]['temperature'] = temperature
+        if answer is not None:
+            try:
+                answer = float(answer)
+            except (TypeError, ValueError):
+                raise ValueError(f"Score of segment {hypothesis_index} of {system} has to be a number or None, got {answer!r}.")
+        self.scores[index] = np.nan if answer is None else answer
+        self.temperatures[index] = np.nan if temperature is None else temperature
+
+        system_index = hypothesis_index % len(self.testset.sources)
+        self.journal_buffer.append(f"{system}\t{system_index}\t{format_value(self.scores[index])}\t{format_value(self.temperatures[index])}\n")
+        if len(self.journal_buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Appends the scores assigned since the last flush to the journal."""
+        if len(self.journal_buffer) > 0:
+            if self.journal is None:
+                self.journal = open(self.get_journal_path(), "a")
+            self.journal.writelines(self.journal_buffer)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_buffer = []
+        self.last_flush = time.monotonic()
 
     def save(self):
+        segment_count = len(self.testset.sources)
+        system_column = np.repeat(self.systems, segment_count)
+        # the journal stays until all files are written
+        self.flush()
+
         # segment level scores
-        self.seg_scores.to_csv(self.get_seg_path(), sep="\t", index=False, header=False, na_rep="None")
+        atomic_write(self.get_seg_path(), (f"{system}\t{format_value(score)}\n" for system, score in zip(system_column, self.scores.tolist())))
 
-        # system scores
-        self.seg_scores.score = self.seg_scores.score.replace("None", None).astype(float)
-        sys_scores_df = self.seg_scores.groupby(['system'], as_index=False, dropna=True).mean()
-        sys_scores_df.to_csv(self.get_sys_path(), sep="\t", index=False, header=False, na_rep="None")
+        # system scores, mean of the available segment scores
+        df = pd.DataFrame({"system": system_column, "score": self.scores})
+        sys_scores = df.groupby("system", sort=True)["score"].mean()
+        atomic_write(self.get_sys_path(), (f"{system}\t{format_mean(score)}\n" for system, score in sys_scores.items()))
 
         # domain scores
-        df = self.seg_scores.copy()
-        documents = self.testset.documents
-        total_systems = len(self.testset.systems)
-        df["domains"] = pd.DataFrame([x.split("\t")[0] for x in documents] * total_systems)[0]
-        df = df.groupby(["domains", 'system'], as_index=False, dropna=True).mean()
-        df.to_csv(self.get_domain_path(), sep="\t", index=False, header=False, na_rep="None")
+        df["domains"] = [x.split("\t")[0] for x in self.testset.documents] * len(self.systems)
+        domain_scores = df.groupby(["domains", "system"], sort=True)["score"].mean()
+        atomic_write(self.get_domain_path(), (f"{domain}\t{system}\t{format_mean(score)}\n" for (domain, system), score in domain_scores.items()))
 
         # metadata
-        self.metadata.to_csv(self.get_meta_path(), sep="\t", index=False, header=False, na_rep="None")
+        atomic_write(self.get_meta_path(), (f"{system}\t{format_value(temperature)}\n" for system, temperature in zip(system_column, self.temperatures.tolist())))
+
+        # everything in the journal is now in the files
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.isfile(self.get_journal_path()):
+            os.remove(self.get_journal_path())
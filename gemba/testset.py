@@ -1,5 +1,91 @@
 import glob
+import json
+import mmap
 import os
+import shutil
+import tempfile
+from collections.abc import Sequence
+import numpy as np
+
+
+class SegmentView(Sequence):
+    """Read-only list of the segments of one file of a snapshot, strings are decoded on access."""
+
+    def __init__(self, snapshot, ids):
+        self.snapshot = snapshot
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.snapshot.get_string(self.ids[index])
+
+    def __iter__(self):
+        for string_id in self.ids.tolist():
+            yield self.snapshot.get_string(string_id)
+
+
+class Snapshot:
+    """
+    Binary snapshot of the segment files of a language pair: every distinct segment is stored once in a blob of
+    UTF-8 strings with an offset array, each file is an array of string ids. Arrays and blob are memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}/meta.json", "r") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(f"{path}/offsets.npy", mmap_mode="r")
+        self.ids = np.load(f"{path}/ids.npy", mmap_mode="r")
+        with open(f"{path}/strings.bin", "rb") as f:
+            # mmap can't map an empty file
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f"{path}/strings.bin") > 0 else b""
+
+    def get_string(self, string_id):
+        return self.blob[self.offsets[string_id]:self.offsets[string_id + 1]].decode("utf-8")
+
+    def get_file(self, name):
+        start, length = self.meta["files"][name]
+        return SegmentView(self, self.ids[start:start + length])
+
+    @staticmethod
+    def write(path, files, sources):
+        """Writes {name: list of segments} to path, sources are {name: [input path, mtime]} for the staleness check."""
+        os.makedirs(path, exist_ok=True)
+        string_ids = {}
+        ids = []
+        meta = {"files": {}, "sources": sources}
+        for name, segments in files.items():
+            meta["files"][name] = [len(ids), len(segments)]
+            for segment in segments:
+                ids.append(string_ids.setdefault(segment, len(string_ids)))
+
+        encoded = [string.encode("utf-8") for string in string_ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+
+        # files are written to a temporary directory and moved in place, the old files stay intact for readers
+        # which mapped them and until the new ones are complete
+        tmp = tempfile.mkdtemp(dir=path, prefix="tmp-")
+        try:
+            with open(f"{tmp}/strings.bin", "wb") as f:
+                f.write(b"".join(encoded))
+            np.save(f"{tmp}/offsets.npy", offsets)
+            np.save(f"{tmp}/ids.npy", np.array(ids, dtype=np.int32))
+            with open(f"{tmp}/meta.json", "w") as f:
+                json.dump(meta, f)
+
+            # a snapshot without meta.json is incomplete, it is removed first and moved in last so that an
+            # interrupted write never leaves the old meta.json pointing at new arrays
+            if os.path.isfile(f"{path}/meta.json"):
+                os.remove(f"{path}/meta.json")
+            for name in ["strings.bin", "offsets.npy", "ids.npy", "meta.json"]:
+                os.replace(f"{tmp}/{name}", f"{path}/{name}")
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
 
 
 class Testset:
@@ -16,27 +102,65 @@ class Testset:
 
         self.load()
 
-    def load(self):
+    def get_input_files(self):
+        """Paths of the segment files of the language pair, by their name in the testset."""
         dataset = f"{self.basepath}/{self.dataset}"
-
-        self.sources = self.load_segment_files(f"{dataset}/sources/{self.lp}.txt")
+        files = {"sources": f"{dataset}/sources/{self.lp}.txt"}
 
         # list all files in references folder
-        refs = glob.glob(f"{dataset}/references/{self.lp}.*.txt")
-        for reffile in refs:
-            refname = reffile.split('.')[-2]
-            if self.main_ref is None:
-                self.main_ref = refname
-            self.references[refname] = self.load_segment_files(reffile)
+        for reffile in glob.glob(f"{dataset}/references/{self.lp}.*.txt"):
+            files[f"references/{reffile.split('.')[-2]}"] = reffile
 
         systems = f"{dataset}/system-outputs/{self.lp}"
         # keep systems in order
-        all_systems = sorted(os.listdir(systems))
-        for system in all_systems:
-            systemname = system.replace(".txt", "")
-            self.systems[systemname] = self.load_segment_files(f"{systems}/{system}")
+        for system in sorted(os.listdir(systems)):
+            files[f"systems/{system.replace('.txt', '')}"] = f"{systems}/{system}"
+
+        files["documents"] = f"{dataset}/documents/{self.lp}.docs"
+        return files
+
+    def get_snapshot_path(self):
+        return f"{self.basepath}/{self.dataset}/snapshots/{self.lp}"
+
+    def load(self):
+        files = self.get_input_files()
+        snapshot = self.load_snapshot(files)
+        if snapshot is not None:
+            segments = {name: snapshot.get_file(name) for name in files}
+        else:
+            segments = {name: self.load_segment_files(path) for name, path in files.items()}
+
+        for name, segment_list in segments.items():
+            if name == "sources":
+                self.sources = segment_list
+            elif name == "documents":
+                self.documents = segment_list
+            elif name.startswith("references/"):
+                refname = name.split("/", 1)[1]
+                if self.main_ref is None:
+                    self.main_ref = refname
+                self.references[refname] = segment_list
+            else:
+                self.systems[name.split("/", 1)[1]] = segment_list
+
+    def load_snapshot(self, files):
+        """Returns the snapshot of the language pair, None when there is none or any input file changed since."""
+        path = self.get_snapshot_path()
+        if not os.path.isfile(f"{path}/meta.json"):
+            return None
+        snapshot = Snapshot(path)
+        sources = {name: [file, os.path.getmtime(file)] for name, file in files.items()}
+        if snapshot.meta["sources"] != sources:
+            print(f"Snapshot {path} is outdated, reading the text files instead.")
+            return None
+        return snapshot
 
-        self.documents = self.load_segment_files(f"{dataset}/documents/{self.lp}.docs")
+    def save_snapshot(self):
+        """Converts the segment files of the language pair into a snapshot which load() uses from then on."""
+        files = self.get_input_files()
+        segments = {name: self.load_segment_files(path) for name, path in files.items()}
+        sources = {name: [file, os.path.getmtime(file)] for name, file in files.items()}
+        Snapshot.write(self.get_snapshot_path(), segments, sources)
 
     def iterate_over_all(self, reference=None):
         for system in self.systems.keys():
@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import math
+from collections import deque
+from gemba.rate_limiter import count_tokens
+
+
+# max_tokens of truncated answers are raised to this in a single step
+MAX_TOKENS_LIMIT = 1200
+
+
+class TokenBudget:
+    """
+    Chooses max_tokens of requests from the completion lengths observed per (method, model).
+
+    The lengths are seeded from a sample of the answers already in the cache, or of the given cache keys of
+    a stage when the cache is shared by several stages, and updated with every new answer. Lengths are the
+    completion tokens reported by the API, answers cached without them are estimated with count_tokens. Until
+    there are min_samples of them, the default max_tokens of the request is used.
+    """
+
+    def __init__(self, percentile=99, margin=1.25, min_samples=20, max_samples=10000, seed_samples=1000, max_tokens_limit=MAX_TOKENS_LIMIT):
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.seed_samples = seed_samples
+        self.max_tokens_limit = max_tokens_limit
+        # most recent lengths and the max_tokens computed from them, recomputed after every 100 new lengths
+        self.lengths = {}
+        self.limits = {}
+        self.observed = {}
+        # seeding tasks, awaited by all requests of the (name, model)
+        self.seeding = {}
+
+    def observe(self, name, model, answer, tokens=None):
+        """tokens is the length reported by the API, it is estimated from the answer otherwise."""
+        key = (name, model)
+        if key not in self.lengths:
+            self.lengths[key] = deque(maxlen=self.max_samples)
+        self.lengths[key].append(tokens if tokens is not None else count_tokens(answer, model))
+        self.observed[key] = self.observed.get(key, 0) + 1
+        if self.observed[key] % 100 == 0:
+            self.limits.pop(key, None)
+
+    async def seed(self, name, model, cache, keys=None):
+        """
+        Observes the lengths of a sample of cached answers, once per (name, model). The sample is taken from
+        keys if given, otherwise from the whole cache.
+        """
+        key = (name, model)
+        if key not in self.seeding:
+            self.seeding[key] = asyncio.ensure_future(self._seed(name, model, cache, keys))
+        await asyncio.shield(self.seeding[key])
+
+    async def _seed(self, name, model, cache, keys):
+        def read_answers():
+            answers = []
+            # read through the cache so that answers not yet written to disk count too, keys of a stage may not be
+            # cached at all, the sample is made of the first seed_samples cached ones
+            cached = (cache.get(key) for key in (cache.iterkeys() if keys is None else keys))
+            for cached_answers in itertools.islice(filter(None, cached), self.seed_samples):
+                for answer in cached_answers:
+                    if answer.get("finish_reason") == "stop":
+                        # answers cached before the usage was recorded are estimated
+                        answers.append((answer["answer"], answer.get("completion_tokens")))
+            return answers
+
+        for answer, tokens in await asyncio.get_running_loop().run_in_executor(None, read_answers):
+            self.observe(name, model, answer, tokens)
+
+    def max_tokens(self, name, model, default=None):
+        key = (name, model)
+        lengths = self.lengths.get(key)
+        if lengths is None or len(lengths) < self.min_samples:
+            return default
+        if key not in self.limits:
+            lengths = sorted(lengths)
+            length = lengths[min(len(lengths) - 1, math.ceil(len(lengths) * self.percentile / 100) - 1)]
+            self.limits[key] = min(self.max_tokens_limit, math.ceil(length * self.margin) + 1)
+        return self.limits[key]
+
+    def escalate(self, max_tokens):
+        """max_tokens for re-requesting a truncated answer, None if it can't be raised anymore."""
+        if max_tokens is None or max_tokens >= self.max_tokens_limit:
+            return None
+        return self.max_tokens_limit
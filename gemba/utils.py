@@ -1,51 +1,236 @@
+import sys
 import ipdb
 import pandas as pd
-import diskcache as dc
 from gemba.gpt_api import GptApi
+from gemba.cache import get_cache, cache_key, install_signal_handlers
+from gemba.packing import PACKABLE_METHODS, PACKED_LINE_TOKENS, PACKED_MAX_TOKENS, create_packed_prompt, parse_packed_answer
 from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template, parse_mqm_answer
 from gemba.gemba_esa import TEMPLATE_GEMBA_ESA_ERROR_SPANS, TEMPLATE_GEMBA_ESA_RANKING
 from gemba.prompt import prompts, validate_number, create_polycand_prompt, create_polyic_prompt
 import asyncio
+import threading
+import weakref
+from collections import deque
+from itertools import zip_longest
 
 
-def get_gemba_scores(source, hypothesis, source_lang, target_lang, method, model):
+def template_stage(name, template, validate_answer, max_tokens=None, output="answer"):
+    return {
+        "name": name,
+        "prompt": lambda row: apply_template(template, row),
+        "validate_answer": validate_answer,
+        "max_tokens": max_tokens,
+        "output": output,
+    }
+
+
+# requests of each method as a chain of stages, a stage can use the outputs of the previous ones in its template,
+# max_tokens is the initial value until the lengths of the answers of the stage are known
+method_stages = {
+    "GEMBA-MQM": [
+        template_stage("GEMBA-MQM", TEMPLATE_GEMBA_MQM, lambda x: parse_mqm_answer(x, list_mqm_errors=False, full_desc=True), max_tokens=500),
+    ],
+    "GEMBA-ESA": [
+        template_stage("GEMBA-ESA:error_spans", TEMPLATE_GEMBA_ESA_ERROR_SPANS, lambda x: x, max_tokens=500, output="error_spans"),
+        template_stage("GEMBA-ESA", TEMPLATE_GEMBA_ESA_RANKING, validate_number, max_tokens=100),
+    ],
+    **{
+        method: [template_stage(method, prompts[method]['prompt'], prompts[method]["validate_answer"], max_tokens=500)]
+        for method in PACKABLE_METHODS
+    },
+}
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+# GptApi used by the calls which don't pass one, the client of a GptApi is bound to a single event loop
+_default_gptapis = weakref.WeakKeyDictionary()
+
+
+def get_background_loop():
+    """Event loop of the sync API, it runs in a daemon thread so that clients and caches are reused across calls."""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="gemba-loop", daemon=True).start()
+        return _background_loop
+
+
+def run_sync(coroutine):
+    """Runs a coroutine of the async API to completion, also when called from a thread with a running event loop."""
+    loop = get_background_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    assert running_loop is not loop, "The sync API can't be called from the async API, await the coroutine instead."
+
+    # the caches are opened in the loop thread, the signal handlers must be installed from the main thread
+    install_signal_handlers()
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. KeyboardInterrupt, don't leave the requests running in the background
+        future.cancel()
+        raise
+
+
+def get_default_gptapi():
+    loop = asyncio.get_running_loop()
+    if loop not in _default_gptapis:
+        _default_gptapis[loop] = GptApi()
+    return _default_gptapis[loop]
+
+
+def deduplicate(df, columns):
+    """Returns the unique rows of df over the columns and, for each original row, the index of its unique row."""
+    inverse = df.groupby(columns, sort=False, dropna=False).ngroup().to_numpy()
+    unique_df = df.drop_duplicates(subset=columns).reset_index(drop=True)
+    return unique_df, inverse
+
+
+async def prefill_packed(gptapi, df, method, model, cache, pack_size):
+    """
+    Requests uncached segments in packs of pack_size segments of the same language pair per prompt.
+
+    Each answer of a packed prompt is cached under the key of its single-segment prompt, so
+    pipeline_request resolves it from the cache and packed and unpacked runs share answers. Segments which
+    are missing from the packed answer or fail to parse are left to the regular single-segment requests.
+    The raw packed answers are kept in a separate cache, the method's cache only holds single-segment answers.
+    """
+    validate_answer = prompts[method]["validate_answer"]
+    prompt_keys = [cache_key(model, 0, apply_template(prompts[method]["prompt"], row)) for row in df.to_dict("records")]
+    cached_answers = await cache.aget_many(prompt_keys)
+    misses = [i for i, answers in enumerate(cached_answers) if answers is None or len(answers) == 0]
+
+    packs = []
+    for _, group in df.iloc[misses].groupby(["source_lang", "target_lang"], sort=False):
+        indices = list(group.index)
+        for start in range(0, len(indices), pack_size):
+            packs.append(indices[start:start + pack_size])
+
+    # room for the answer of every segment as learned for single-segment requests of the method
+    segment_max_tokens = await gptapi.get_max_tokens(method_stages[method][0], model, cache)
+    packed_cache = get_cache(f"{cache.directory}-packed")
+
+    async def request_pack(pack):
+        prompt = create_packed_prompt(method, [df.loc[i] for i in pack])
+        parse_answer = lambda x: parse_packed_answer(x, len(pack), validate_answer)
+        max_tokens = min(PACKED_MAX_TOKENS, (segment_max_tokens + PACKED_LINE_TOKENS) * len(pack))
+        answers = await gptapi.request(prompt, model, parse_answer, cache=packed_cache, max_tokens=max_tokens)
+        items = answers[0]["answer"]
+        if items is None:
+            return 0
+        for i, item in zip(pack, items):
+            if item is not None:
+                cache[prompt_keys[i]] = [{"answer": item, "finish_reason": "stop"}]
+        return sum(item is not None for item in items)
+
+    answered = sum(await asyncio.gather(*[request_pack(pack) for pack in packs]))
+    gptapi.stats["packed_requests"] += len(packs)
+    gptapi.stats["packed_fallbacks"] += len(misses) - answered
+    print(f"Packed requests answered {answered} of {len(misses)} segments", file=sys.stderr)
+
+
+async def aget_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, gptapi=None, reference=None, pack_size=1):
     df = pd.DataFrame({'source_seg': source, 'target_seg': hypothesis})
     df['source_lang'] = source_lang
     df['target_lang'] = target_lang
+    if reference is not None:
+        df['reference_seg'] = reference
 
-    cache = dc.Cache(f'cache/{model}_{method}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
-    gptapi = GptApi()
-
-    if method == "GEMBA-MQM":
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_MQM, x), axis=1)
-        parse_answer = lambda x: parse_mqm_answer(x, list_mqm_errors=False, full_desc=True)
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
-    elif method in ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-stars", "GEMBA-stars_ref", "GEMBA-classes", "GEMBA-classes_ref"]:
-        df["prompt"] = df.apply(lambda x: apply_template(prompts[method]['prompt'], x), axis=1)
-        parse_answer = prompts[method]["validate_answer"]
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
-    elif method == "GEMBA-ESA":
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_ERROR_SPANS, x), axis=1)
-        parse_answer = lambda x: x
-        error_spans = gptapi.bulk_request(df, model, parse_answer, cache=cache)
-        df['error_spans'] = pd.DataFrame(error_spans)['answer']
-
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_RANKING, x), axis=1)
-        parse_answer = validate_number
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache)
-    else:
+    # many systems produce identical translations, score each unique segment only once
+    all_rows = len(df)
+    df, inverse = deduplicate(df, list(df.columns))
+    if len(df) < all_rows:
+        print(f"Scoring {len(df)} unique segments out of {all_rows}", file=sys.stderr)
+
+    if pack_size > 1:
+        assert method in PACKABLE_METHODS, f"Method {method} doesn't support packing."
+    if method not in method_stages:
         raise Exception(f"Method {method} not supported.")
 
-    return list(pd.DataFrame(answers)['answer'])
+    cache = get_cache(f'cache/{model}_{method}')
+    if gptapi is None:
+        gptapi = get_default_gptapi()
 
+    if pack_size > 1:
+        await prefill_packed(gptapi, df, method, model, cache, pack_size)
+    answers = await gptapi.pipeline_request(df, model, method_stages[method], cache)
 
-def get_gemba_scores_polycand(
+    answers = list(pd.DataFrame(answers)['answer'])
+    return [answers[i] for i in inverse]
+
+
+def get_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, gptapi=None, reference=None, pack_size=1):
+    """Sync variant of aget_gemba_scores."""
+    return run_sync(aget_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, gptapi=gptapi, reference=reference, pack_size=pack_size))
+
+
+async def score_segment(gptapi, data, method, model, cache):
+    """Scores a single segment, data is a dict with source_seg, target_seg, source_lang and target_lang."""
+    if method not in method_stages:
+        raise Exception(f"Method {method} not supported.")
+
+    answers = await gptapi.run_stages(dict(data), model, method_stages[method], cache)
+    return answers[0]['answer']
+
+
+async def stream_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, window=1000, gptapi=None):
+    """
+    Streaming variant of get_gemba_scores. Source and hypothesis can be any (lazy) iterables of segments.
+
+    At most `window` segments are in flight at once. Scores are yielded in input order as soon as
+    all previous segments are scored, finished segments wait in the reorder buffer until then.
+    """
+    if method not in method_stages:
+        raise Exception(f"Method {method} not supported.")
+
+    cache = get_cache(f'cache/{model}_{method}')
+    if gptapi is None:
+        gptapi = get_default_gptapi()
+
+    # tasks in input order, the head is always the next score to be emitted
+    pending = deque()
+    try:
+        for source_seg, target_seg in zip_longest(source, hypothesis):
+            assert source_seg is not None and target_seg is not None, "Source and hypothesis files must have the same number of lines."
+            data = {
+                "source_seg": source_seg,
+                "target_seg": target_seg,
+                "source_lang": source_lang,
+                "target_lang": target_lang,
+            }
+            pending.append(asyncio.ensure_future(score_segment(gptapi, data, method, model, cache)))
+
+            if len(pending) >= window:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def polycand_cache_dir(cache_root_dir, model, method, additional_translation_in, additional_score_in, additional_score_out, use_ref):
+    return f'{cache_root_dir}/{model}_{method}_{additional_translation_in}_{additional_score_in}_{additional_score_out}_{use_ref}'
+
+
+def polyic_cache_dir(cache_root_dir, model, method, additional_sample_in, use_ref):
+    return f'{cache_root_dir}/{model}_{method}_{additional_sample_in}_{use_ref}'
+
+
+async def aget_gemba_scores_polycand(
         df, method, model,
         additional_translation_in: int = 0,
         additional_score_in: int = 0,
         additional_score_out: int = 0,
         use_ref: bool = False,
-        cache_root_dir: str = "cache"
+        cache_root_dir: str = "cache",
+        gptapi: GptApi = None
 ):
     """
     Args:
@@ -63,23 +248,26 @@ def get_gemba_scores_polycand(
         axis=1
     )
 
-    cache = dc.Cache(
-        f'{cache_root_dir}/{model}_{method}_{additional_translation_in}_{additional_score_in}_{additional_score_out}_{use_ref}',
-        expire=None, size_limit=int(10e10), cull_limit=0,
-        eviction_policy='none'
-    )
-    gptapi = GptApi()
+    cache = get_cache(polycand_cache_dir(cache_root_dir, model, method, additional_translation_in, additional_score_in, additional_score_out, use_ref))
+    if gptapi is None:
+        gptapi = get_default_gptapi()
     parse_answer = prompts[method]["validate_answer"]
-    answers = asyncio.run(gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500))
+    # identical prompts are requested only once
+    unique_df, inverse = deduplicate(df, ["prompt"])
+    answers = await gptapi.bulk_request(unique_df, model, parse_answer, cache=cache, max_tokens=500, name=method)
+    # answers only reference their prompt by id, the full output keeps the prompt
+    for answer, prompt in zip(answers, unique_df["prompt"]):
+        answer["prompt"] = prompt
 
-    return answers
+    return [answers[i] for i in inverse]
 
 
-def get_gemba_scores_polyic(
+async def aget_gemba_scores_polyic(
         df, method, model,
         additional_sample_in: int = 0,
         use_ref: bool = False,
-        cache_root_dir: str = "cache"
+        cache_root_dir: str = "cache",
+        gptapi: GptApi = None
 ):
     """
     Args:
@@ -95,13 +283,42 @@ def get_gemba_scores_polyic(
         axis=1
     )
 
-    cache = dc.Cache(
-        f'{cache_root_dir}/{model}_{method}_{additional_sample_in}_{use_ref}',
-        expire=None, size_limit=int(10e10), cull_limit=0,
-        eviction_policy='none'
-    )
-    gptapi = GptApi()
+    cache = get_cache(polyic_cache_dir(cache_root_dir, model, method, additional_sample_in, use_ref))
+    if gptapi is None:
+        gptapi = get_default_gptapi()
     parse_answer = prompts[method]["validate_answer"]
-    answers = asyncio.run(gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500))
+    # identical prompts are requested only once
+    unique_df, inverse = deduplicate(df, ["prompt"])
+    answers = await gptapi.bulk_request(unique_df, model, parse_answer, cache=cache, max_tokens=500, name=method)
+    # answers only reference their prompt by id, the full output keeps the prompt
+    for answer, prompt in zip(answers, unique_df["prompt"]):
+        answer["prompt"] = prompt
 
-    return answers
+    return [answers[i] for i in inverse]
+
+
+def get_gemba_scores_polycand(
+        df, method, model,
+        additional_translation_in: int = 0,
+        additional_score_in: int = 0,
+        additional_score_out: int = 0,
+        use_ref: bool = False,
+        cache_root_dir: str = "cache",
+        gptapi: GptApi = None
+):
+    """Sync variant of aget_gemba_scores_polycand."""
+    return run_sync(aget_gemba_scores_polycand(
+        df, method, model, additional_translation_in=additional_translation_in, additional_score_in=additional_score_in,
+        additional_score_out=additional_score_out, use_ref=use_ref, cache_root_dir=cache_root_dir, gptapi=gptapi))
+
+
+def get_gemba_scores_polyic(
+        df, method, model,
+        additional_sample_in: int = 0,
+        use_ref: bool = False,
+        cache_root_dir: str = "cache",
+        gptapi: GptApi = None
+):
+    """Sync variant of aget_gemba_scores_polyic."""
+    return run_sync(aget_gemba_scores_polyic(
+        df, method, model, additional_sample_in=additional_sample_in, use_ref=use_ref, cache_root_dir=cache_root_dir, gptapi=gptapi))
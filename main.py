@@ -1,10 +1,13 @@
 import os
 import sys
+import asyncio
 import ipdb
 import pandas as pd
 import diskcache as dc
 from absl import app, flags
-from gemba.utils import get_gemba_scores
+from gemba.gpt_api import GptApi
+from gemba.rate_limiter import load_rate_limits
+from gemba.utils import get_gemba_scores, stream_gemba_scores
 
 
 flags.DEFINE_string('method', "GEMBA-MQM", 'Which method to use?')
@@ -13,6 +16,31 @@ flags.DEFINE_string('source', None, 'Filepath to the source file.')
 flags.DEFINE_string('hypothesis', None, 'Filepath to the translation file.')
 flags.DEFINE_string('source_lang', None, 'Source language name.')
 flags.DEFINE_string('target_lang', None, 'Target language name.')
+flags.DEFINE_string('output', None, 'Filepath to write the scores to, defaults to stdout.')
+flags.DEFINE_boolean('streaming', False, 'Read the input lazily and write scores as soon as they are ready.')
+flags.DEFINE_integer('window', 1000, 'Maximum number of segments in flight in streaming mode.')
+flags.DEFINE_integer('min_concurrency', 1, 'Lower bound of the adaptive number of concurrent API requests.')
+flags.DEFINE_integer('max_concurrency', 800, 'Upper bound of the adaptive number of concurrent API requests.')
+flags.DEFINE_integer('rpm', None, 'Requests per minute allowed for the model.')
+flags.DEFINE_integer('tpm', None, 'Tokens per minute allowed for the model.')
+flags.DEFINE_string('rate_limits', None, 'Filepath to a JSON file with per model/deployment limits, e.g. {"gpt-4": {"rpm": 480, "tpm": 80000}}.')
+flags.DEFINE_integer('max_attempts', 10, 'Maximum number of attempts per API request before giving up.')
+flags.DEFINE_boolean('batch', False, 'Request uncached prompts through the OpenAI Batch API first.')
+flags.DEFINE_integer('batch_poll_interval', 60, 'Seconds between polls of the Batch API.')
+flags.DEFINE_enum('retry_strategy', "escalate", ["escalate", "sample"], 'Retry unparseable answers with increasing temperature one call at a time, or by sampling several answers in one call.')
+flags.DEFINE_integer('retry_samples', 5, 'Number of answers sampled in one call by the "sample" retry strategy.')
+flags.DEFINE_integer('pack_size', 1, 'Number of segments scored by a single request (GEMBA-DA, SQM, stars and classes only).')
+
+
+def read_segments(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield line.strip()
+
+
+async def stream_to(out, source, hypothesis, gptapi, FLAGS):
+    async for answer in stream_gemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, window=FLAGS.window, gptapi=gptapi):
+        print(answer, file=out, flush=True)
 
 
 def main(argv):
@@ -30,21 +58,32 @@ def main(argv):
 
     assert FLAGS.source_lang is not None, "Source language name must be provided."
     assert FLAGS.target_lang is not None, "Target language name must be provided."
+    assert not (FLAGS.streaming and FLAGS.batch), "Batch mode is not supported in streaming mode."
+    assert not (FLAGS.streaming and FLAGS.pack_size > 1), "Packing is not supported in streaming mode."
+
+    rate_limits = load_rate_limits(FLAGS.rate_limits, FLAGS.model, FLAGS.rpm, FLAGS.tpm)
+    gptapi = GptApi(min_concurrency=FLAGS.min_concurrency, max_concurrency=FLAGS.max_concurrency, rate_limits=rate_limits, max_attempts=FLAGS.max_attempts,
+                    batch=FLAGS.batch, batch_poll_interval=FLAGS.batch_poll_interval,
+                    retry_strategy=FLAGS.retry_strategy, retry_samples=FLAGS.retry_samples)
+    out = open(FLAGS.output, 'w') if FLAGS.output is not None else sys.stdout
+
+    if FLAGS.streaming:
+        asyncio.run(stream_to(out, read_segments(FLAGS.source), read_segments(FLAGS.hypothesis), gptapi, FLAGS))
+    else:
+        # load both files and strip them
+        source = list(read_segments(FLAGS.source))
+        hypothesis = list(read_segments(FLAGS.hypothesis))
 
-    # load both files and strip them
-    with open(FLAGS.source, 'r') as f:
-        source = f.readlines()
-    source = [x.strip() for x in source]
-    with open(FLAGS.hypothesis, 'r') as f:
-        hypothesis = f.readlines()
-    hypothesis = [x.strip() for x in hypothesis]
+        assert len(source) == len(hypothesis), "Source and hypothesis files must have the same number of lines."
 
-    assert len(source) == len(hypothesis), "Source and hypothesis files must have the same number of lines."
+        answers = get_gemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, gptapi=gptapi, pack_size=FLAGS.pack_size)
 
-    answers = get_gemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model)
+        for answer in answers:
+            print(answer, file=out)
 
-    for answer in answers:
-        print(answer)
+    if out is not sys.stdout:
+        out.close()
+    gptapi.print_stats()
 
 if __name__ == "__main__":
     app.run(main)
@@ -0,0 +1,36 @@
+import glob
+import os
+import sys
+import sqlite3
+from absl import app, flags
+from gemba.cache import open_disk_cache, migrate_cache
+
+
+flags.DEFINE_string('cache_root_dir', "cache", 'Path to the cache directory.')
+flags.DEFINE_string('pattern', "*", 'Glob pattern of the cache subdirectories to migrate, e.g. "gpt-4_GEMBA-MQM".')
+flags.DEFINE_boolean('vacuum', True, 'Compact the SQLite database after the migration to reclaim the space of the old keys.')
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+
+    directories = sorted(glob.glob(f"{FLAGS.cache_root_dir}/{FLAGS.pattern}"))
+    directories = [d for d in directories if os.path.isfile(f"{d}/cache.db")]
+    if len(directories) == 0:
+        print(f"No caches found in {FLAGS.cache_root_dir}/{FLAGS.pattern}.")
+        sys.exit(1)
+
+    for directory in directories:
+        cache = open_disk_cache(directory)
+        migrated = migrate_cache(cache)
+        print(f"{directory}: migrated {migrated} entries, {len(cache)} entries in total")
+        cache.close()
+
+        if FLAGS.vacuum and migrated > 0:
+            connection = sqlite3.connect(f"{directory}/cache.db")
+            connection.execute("VACUUM")
+            connection.close()
+
+
+if __name__ == "__main__":
+    app.run(main)
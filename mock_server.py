@@ -0,0 +1,312 @@
+import email
+import email.policy
+import itertools
+import math
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from absl import app, flags
+
+
+flags.DEFINE_string('host', "127.0.0.1", 'Host to listen on.')
+flags.DEFINE_integer('port', 8000, 'Port to listen on.')
+flags.DEFINE_string('latency', "fixed:0", 'Latency of chat completions in seconds: fixed:S, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or exponential:MEAN.')
+flags.DEFINE_float('rate_limit_rate', 0, 'Fraction of chat completions failing with 429.')
+flags.DEFINE_float('server_error_rate', 0, 'Fraction of chat completions failing with 500 or 503.')
+flags.DEFINE_float('truncate_rate', 0, 'Fraction of chat completions cut off with finish_reason "length".')
+flags.DEFINE_float('garbage_rate', 0, 'Fraction of chat completions with an answer no parser accepts (except GEMBA-MQM).')
+flags.DEFINE_integer('seed', None, 'Seed of the latencies and injected faults.')
+
+######
+# Local stand-in for the OpenAI API, implements chat completions and the file and batch endpoints.
+# Point the scorer to it with OPENAI_API_KEY=anything OPENAI_BASE_URL=http://127.0.0.1:8000/v1
+# Chat completions can be slowed down and made to fail, see MockConfig.
+######
+
+GARBAGE_ANSWER = "Sorry, I am unable to evaluate this translation."
+
+
+def mock_answer(messages):
+    """Returns an answer which the parser of the prompted method accepts."""
+    prompt = messages[-1]["content"]
+    packed = re.split(r"\n\nTranslation (\d+):\n", prompt)
+    if len(packed) > 1:
+        # packed prompt, answer each numbered segment
+        header = packed[0]
+        return "\n".join(f"{number}: {mock_answer([{'role': 'user', 'content': header + segment}])}" for number, segment in zip(packed[1::2], packed[2::2]))
+    if any(turn["role"] == "system" for turn in messages):
+        # GEMBA-MQM and GEMBA-ESA error spans
+        return 'Critical:\nno-error\nMajor:\nno-error\nMinor:\nfluency/grammar - "translation"\n'
+    if "one to five stars" in prompt:
+        return "4 stars"
+    if "Classify the quality" in prompt:
+        return "Most meaning preserved, minor issues"
+    if "remember to output the final score" in prompt:
+        return "The translation is mostly accurate. 85"
+    return str(len(prompt) % 101)
+
+
+def chat_completion(body, answer=None, finish_reason="stop"):
+    if answer is None:
+        answer = mock_answer(body["messages"])
+    prompt_tokens = sum(len(turn["content"]) for turn in body["messages"]) // 4
+    completion_tokens = len(answer) // 4 + 1
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{
+            "index": i,
+            "finish_reason": finish_reason,
+            "message": {"role": "assistant", "content": answer},
+        } for i in range(body.get("n", 1))],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class MockConfig:
+    """
+    Latency distribution and fault injection of the chat completions endpoint, rates are fractions of the
+    requests. Rate limited requests ask for a retry after retry_after_ms milliseconds.
+    """
+
+    def __init__(self, latency="fixed:0", rate_limit_rate=0, server_error_rate=0, truncate_rate=0, garbage_rate=0,
+                 retry_after_ms=50, seed=None):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.truncate_rate = truncate_rate
+        self.garbage_rate = garbage_rate
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        # fails early on an invalid latency specification
+        self.sample_latency()
+
+    def sample_latency(self):
+        kind, *params = self.latency.split(":")
+        params = [float(param) for param in params]
+        if kind == "fixed":
+            return params[0]
+        elif kind == "uniform":
+            return self.random.uniform(params[0], params[1])
+        elif kind == "lognormal":
+            return self.random.lognormvariate(math.log(params[0]), params[1])
+        elif kind == "exponential":
+            return self.random.expovariate(1 / params[0])
+        raise Exception(f"Latency distribution {kind} not supported.")
+
+    def sample_fault(self):
+        """Returns the fault to inject into a request, None for a regular answer."""
+        value = self.random.random()
+        for fault, rate in [("rate_limit", self.rate_limit_rate), ("server_error", self.server_error_rate),
+                            ("truncate", self.truncate_rate), ("garbage", self.garbage_rate)]:
+            if value < rate:
+                return fault
+            value -= rate
+        return None
+
+
+class MockState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.files = {}
+        self.batches = {}
+        self.requests = 0
+        self.faults = Counter()
+
+    def new_id(self, prefix):
+        with self.lock:
+            return f"{prefix}-{next(self.ids)}"
+
+    def add_file(self, content, filename, purpose):
+        file_id = self.new_id("file")
+        self.files[file_id] = {
+            "content": content,
+            "object": {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+            },
+        }
+        return self.files[file_id]["object"]
+
+    def create_batch(self, body, handler):
+        batch_id = self.new_id("batch")
+        lines = self.files[body["input_file_id"]]["content"].decode("utf-8").splitlines()
+        outputs = []
+        for line in lines:
+            if line.strip() == "":
+                continue
+            request = json.loads(line)
+            outputs.append(json.dumps({
+                "id": self.new_id("batch_req"),
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": "mock", "body": handler.complete(request["body"])},
+                "error": None,
+            }))
+        output = self.add_file(("\n".join(outputs) + "\n").encode("utf-8"), f"{batch_id}_output.jsonl", "batch_output")
+
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "completion_window": body["completion_window"],
+            "input_file_id": body["input_file_id"],
+            "created_at": int(time.time()),
+            # the first poll reports the batch as in progress, the following ones as completed
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": len(outputs), "completed": 0, "failed": 0},
+            "_output_file_id": output["id"],
+        }
+        return self.public_batch(batch_id)
+
+    def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch["status"] == "in_progress":
+            batch["status"] = "completed"
+            batch["output_file_id"] = batch["_output_file_id"]
+            batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+        return self.public_batch(batch_id)
+
+    def public_batch(self, batch_id):
+        return {key: value for key, value in self.batches[batch_id].items() if not key.startswith("_")}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, with Nagle every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    state = None
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def complete(self, body):
+        with self.state.lock:
+            self.state.requests += 1
+        return chat_completion(body)
+
+    def complete_with_faults(self, body):
+        """Answers a chat completion after the sampled latency, returns (status, response, headers)."""
+        time.sleep(self.config.sample_latency())
+        fault = self.config.sample_fault()
+        if fault is not None:
+            with self.state.lock:
+                self.state.faults[fault] += 1
+
+        if fault == "rate_limit":
+            error = {"error": {"message": "Rate limit reached (mock).", "type": "requests", "code": "rate_limit_exceeded"}}
+            return 429, error, {"retry-after-ms": str(self.config.retry_after_ms)}
+        elif fault == "server_error":
+            error = {"error": {"message": "The server had an error (mock).", "type": "server_error", "code": None}}
+            return self.config.random.choice([500, 503]), error, None
+
+        response = self.complete(body)
+        if fault == "truncate":
+            for choice in response["choices"]:
+                content = choice["message"]["content"]
+                choice["message"]["content"] = content[:len(content) // 2]
+                choice["finish_reason"] = "length"
+        elif fault == "garbage":
+            for choice in response["choices"]:
+                choice["message"]["content"] = GARBAGE_ANSWER
+        return 200, response, None
+
+    def send_json(self, data, status=200, headers=None):
+        data = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            status, response, headers = self.complete_with_faults(json.loads(self.read_body()))
+            self.send_json(response, status=status, headers=headers)
+        elif path.endswith("/files"):
+            message = email.message_from_bytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self.read_body(),
+                policy=email.policy.HTTP)
+            fields = {}
+            for part in message.iter_parts():
+                fields[part.get_param("name", header="content-disposition")] = part
+            file_part = fields["file"]
+            self.send_json(self.state.add_file(file_part.get_payload(decode=True), file_part.get_filename(), fields["purpose"].get_content().strip()))
+        elif path.endswith("/batches"):
+            self.send_json(self.state.create_batch(json.loads(self.read_body()), self))
+        else:
+            self.send_json({"error": {"message": f"Unknown endpoint {path}", "code": "not_found"}}, status=404)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        content = re.match(r".*/files/([^/]+)/content$", path)
+        batch = re.match(r".*/batches/([^/]+)$", path)
+        if content and content.group(1) in self.state.files:
+            data = self.state.files[content.group(1)]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif batch and batch.group(1) in self.state.batches:
+            self.send_json(self.state.retrieve_batch(batch.group(1)))
+        elif path.endswith("/mock/stats"):
+            with self.state.lock:
+                self.send_json({"requests": self.state.requests, "faults": dict(self.state.faults)})
+        else:
+            self.send_json({"error": {"message": f"Unknown endpoint {path}", "code": "not_found"}}, status=404)
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 refuses connections of highly concurrent clients
+    request_queue_size = 1024
+
+
+def make_server(host="127.0.0.1", port=0, handler=MockHandler, config=None):
+    # every server gets its own state
+    handler = type("Handler", (handler,), {"state": MockState(), "config": config if config is not None else MockConfig()})
+    return MockHTTPServer((host, port), handler)
+
+
+def start_server(host="127.0.0.1", port=0, handler=MockHandler, config=None):
+    """Starts the server in a background thread, returns it and its base URL."""
+    server = make_server(host, port, handler, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    config = MockConfig(FLAGS.latency, FLAGS.rate_limit_rate, FLAGS.server_error_rate, FLAGS.truncate_rate, FLAGS.garbage_rate, seed=FLAGS.seed)
+    server = make_server(FLAGS.host, FLAGS.port, config=config)
+    print(f"Serving mock OpenAI API on http://{FLAGS.host}:{FLAGS.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -4,6 +4,8 @@ import ipdb
 import pandas as pd
 import diskcache as dc
 from absl import app, flags
+from gemba.gpt_api import GptApi
+from gemba.rate_limiter import load_rate_limits
 from gemba.utils import get_gemba_scores_polyic
 
 
@@ -15,14 +17,29 @@ flags.DEFINE_string('out_full_path', None, 'Filepath to the full LLM output.')
 flags.DEFINE_string('out_score_path', None, 'Filepath to the output scores.')
 flags.DEFINE_integer('additional_sample_in', 0, 'Additional samples to include as input.')
 flags.DEFINE_boolean('use_ref', False, 'Whether to use reference translations.')
+flags.DEFINE_integer('min_concurrency', 1, 'Lower bound of the adaptive number of concurrent API requests.')
+flags.DEFINE_integer('max_concurrency', 800, 'Upper bound of the adaptive number of concurrent API requests.')
+flags.DEFINE_integer('rpm', None, 'Requests per minute allowed for the model.')
+flags.DEFINE_integer('tpm', None, 'Tokens per minute allowed for the model.')
+flags.DEFINE_string('rate_limits', None, 'Filepath to a JSON file with per model/deployment limits, e.g. {"gpt-4": {"rpm": 480, "tpm": 80000}}.')
+flags.DEFINE_integer('max_attempts', 10, 'Maximum number of attempts per API request before giving up.')
+flags.DEFINE_boolean('batch', False, 'Request uncached prompts through the OpenAI Batch API first.')
+flags.DEFINE_integer('batch_poll_interval', 60, 'Seconds between polls of the Batch API.')
+flags.DEFINE_enum('retry_strategy', "escalate", ["escalate", "sample"], 'Retry unparseable answers with increasing temperature one call at a time, or by sampling several answers in one call.')
+flags.DEFINE_integer('retry_samples', 5, 'Number of answers sampled in one call by the "sample" retry strategy.')
 
 def main(argv):
     FLAGS = flags.FLAGS
+    rate_limits = load_rate_limits(FLAGS.rate_limits, FLAGS.model, FLAGS.rpm, FLAGS.tpm)
+    gptapi = GptApi(min_concurrency=FLAGS.min_concurrency, max_concurrency=FLAGS.max_concurrency, rate_limits=rate_limits, max_attempts=FLAGS.max_attempts,
+                    batch=FLAGS.batch, batch_poll_interval=FLAGS.batch_poll_interval,
+                    retry_strategy=FLAGS.retry_strategy, retry_samples=FLAGS.retry_samples)
     out = get_gemba_scores_polyic(
             df=pd.read_csv(FLAGS.data_path), method=FLAGS.method, model=FLAGS.model,
             additional_sample_in=FLAGS.additional_sample_in,
             use_ref=FLAGS.use_ref,
             cache_root_dir=FLAGS.cache_root_dir,
+            gptapi=gptapi,
     )
     out = pd.DataFrame(out)
     out.to_csv(FLAGS.out_full_path)
@@ -33,6 +50,8 @@ def main(argv):
         for a in answers:
             file.write(f"{a}\n")
 
+    gptapi.print_stats()
+
 
 if __name__ == "__main__":
     app.run(main)
@@ -0,0 +1,103 @@
+import os
+import sys
+import pandas as pd
+from absl import app, flags
+from gemba.cache import open_disk_cache
+from gemba.prompt import create_polycand_prompt, create_polyic_prompt
+from gemba.reparse import reparse_rows, walk_cache
+from gemba.utils import method_stages, deduplicate, polycand_cache_dir, polyic_cache_dir
+
+
+flags.DEFINE_string('method', "GEMBA-MQM", 'Which method to use?')
+flags.DEFINE_string('model', "gpt-4", 'OpenAI model')
+flags.DEFINE_string('cache_root_dir', "cache", 'Path to the cache directory.')
+flags.DEFINE_string('source', None, 'Filepath to the source file.')
+flags.DEFINE_string('hypothesis', None, 'Filepath to the translation file.')
+flags.DEFINE_string('source_lang', None, 'Source language name.')
+flags.DEFINE_string('target_lang', None, 'Target language name.')
+flags.DEFINE_string('data_path', None, 'Filepath to the csv file of GEMBA-DA-POLYCAND and GEMBA-DA-POLYIC.')
+flags.DEFINE_integer('additional_translation_in', 0, 'Additional translations included as input (GEMBA-DA-POLYCAND).')
+flags.DEFINE_integer('additional_score_in', 0, 'Additional scores included as input (GEMBA-DA-POLYCAND).')
+flags.DEFINE_integer('additional_score_out', 0, 'Additional scores included as output (GEMBA-DA-POLYCAND).')
+flags.DEFINE_integer('additional_sample_in', 0, 'Additional samples included as input (GEMBA-DA-POLYIC).')
+flags.DEFINE_boolean('use_ref', False, 'Whether reference translations were used (GEMBA-DA-POLYCAND and GEMBA-DA-POLYIC).')
+flags.DEFINE_string('output', None, 'Filepath to write the scores to, defaults to stdout.')
+flags.DEFINE_string('misses_output', None, 'Filepath to write the line numbers (0-based) of segments which need a live call.')
+flags.DEFINE_enum('retry_strategy', "escalate", ["escalate", "sample"], 'Retry strategy of the run which filled the cache, it decides the temperatures at which answers are looked up.')
+flags.DEFINE_integer('workers', None, 'Number of parsing processes, defaults to the number of CPUs.')
+
+######
+# Re-applies the current parsers to the raw answers in the cache and writes the scores without any API call.
+# Without input files, it only parses every answer in the cache and reports those which fail to parse.
+######
+
+
+def read_segments(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f]
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+
+    if FLAGS.method == "GEMBA-DA-POLYCAND":
+        cache_dir = polycand_cache_dir(FLAGS.cache_root_dir, FLAGS.model, FLAGS.method, FLAGS.additional_translation_in, FLAGS.additional_score_in, FLAGS.additional_score_out, FLAGS.use_ref)
+    elif FLAGS.method == "GEMBA-DA-POLYIC":
+        cache_dir = polyic_cache_dir(FLAGS.cache_root_dir, FLAGS.model, FLAGS.method, FLAGS.additional_sample_in, FLAGS.use_ref)
+    elif FLAGS.method in method_stages:
+        cache_dir = f'{FLAGS.cache_root_dir}/{FLAGS.model}_{FLAGS.method}'
+    else:
+        raise Exception(f"Method {FLAGS.method} not supported.")
+
+    if not os.path.isdir(cache_dir):
+        print(f"Cache {cache_dir} does not exist.")
+        sys.exit(1)
+    cache = open_disk_cache(cache_dir)
+
+    if FLAGS.source is None and FLAGS.data_path is None:
+        assert FLAGS.method not in method_stages or len(method_stages[FLAGS.method]) == 1, "Multi-stage methods need the input files."
+        walk_cache(cache, FLAGS.method, workers=FLAGS.workers)
+        return
+
+    if FLAGS.method in method_stages:
+        assert FLAGS.hypothesis is not None, "Hypothesis file must be provided."
+        assert FLAGS.source_lang is not None, "Source language name must be provided."
+        assert FLAGS.target_lang is not None, "Target language name must be provided."
+        df = pd.DataFrame({'source_seg': read_segments(FLAGS.source), 'target_seg': read_segments(FLAGS.hypothesis)})
+        df['source_lang'] = FLAGS.source_lang
+        df['target_lang'] = FLAGS.target_lang
+        unique_df, inverse = deduplicate(df, list(df.columns))
+        stages = method_stages[FLAGS.method]
+    else:
+        assert FLAGS.data_path is not None, "Data path must be provided."
+        df = pd.read_csv(FLAGS.data_path)
+        if FLAGS.method == "GEMBA-DA-POLYCAND":
+            df["prompt"] = df.apply(lambda x: create_polycand_prompt(
+                data=x, additional_score_in=FLAGS.additional_score_in, additional_score_out=FLAGS.additional_score_out,
+                additional_translation_in=FLAGS.additional_translation_in, use_ref=FLAGS.use_ref), axis=1)
+        else:
+            df["prompt"] = df.apply(lambda x: create_polyic_prompt(data=x, additional_sample_in=FLAGS.additional_sample_in, use_ref=FLAGS.use_ref), axis=1)
+        unique_df, inverse = deduplicate(df, ["prompt"])
+        stages = [{"prompt": lambda row: row["prompt"], "output": "answer"}]
+
+    answers, misses = reparse_rows(unique_df.to_dict("records"), stages, FLAGS.method, FLAGS.model, cache, workers=FLAGS.workers, retry_strategy=FLAGS.retry_strategy)
+    cache.close()
+
+    out = open(FLAGS.output, 'w') if FLAGS.output is not None else sys.stdout
+    for i in inverse:
+        print(answers[i], file=out)
+    if out is not sys.stdout:
+        out.close()
+
+    # report the lines of the input, not of the unique rows
+    misses = set(misses)
+    missed_lines = [line for line, i in enumerate(inverse) if i in misses]
+    print(f"{len(missed_lines)} of {len(inverse)} segments need a live call", file=sys.stderr)
+    if FLAGS.misses_output is not None:
+        with open(FLAGS.misses_output, 'w') as f:
+            for line in missed_lines:
+                f.write(f"{line}\n")
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,29 @@
+import time
+from absl import app, flags
+from gemba.testset import Testset
+
+
+flags.DEFINE_string('basepath', "mt-metrics-eval-v2", 'Path to the mt-metrics-eval data.')
+flags.DEFINE_string('dataset', "wmt22", 'Dataset to convert.')
+flags.DEFINE_list('lps', ["en-de", "en-ru", "zh-en"], 'Language pairs to convert.')
+
+######
+# Converts the segment files of mt-metrics-eval language pairs into binary snapshots, which Testset
+# memory-maps instead of reading the text files. Snapshots are ignored once any of the files changes.
+######
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    for lp in FLAGS.lps:
+        testset = Testset(FLAGS.basepath, FLAGS.dataset, lp)
+        testset.save_snapshot()
+
+        start = time.time()
+        testset = Testset(FLAGS.basepath, FLAGS.dataset, lp)
+        print(f"Snapshot of {FLAGS.dataset}/{lp} written to {testset.get_snapshot_path()}, "
+              f"{len(testset.systems)} systems of {len(testset.sources)} segments load in {time.time() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    app.run(main)